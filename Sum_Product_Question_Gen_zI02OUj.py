@@ -1,30 +1,37 @@
 import random
 import math
-from typing import Tuple, List, Union, Dict, Set
+from typing import Tuple, List, Union, Dict, Set, Callable
 from enum import Enum
 import numpy as np
 import re
 import sys
 import json
 import html
+import hashlib
+from functools import lru_cache, cached_property, partial
+from collections import deque
+from collections.abc import Mapping
+from itertools import accumulate
+from fractions import Fraction
 
 class DoubleOperationGenerator:
-    def __init__(self):
-        self.expr_gen = ExpressionGenerator()
-        self.range_gen = IndexRangeGenerator()
+    def __init__(self, rng=random):
+        self.rng = rng
+        self.expr_gen = ExpressionGenerator(rng)
+        self.range_gen = IndexRangeGenerator(rng)
     
     def generate_level1(self, operation_type: str = "summation") -> dict:
         """Generate Level 1 double operation with positive indices"""
-        expression = random.choice([
+        expression = self.rng.choice([
             "i+j",
             "i*j",
             "i^j",
-            f"{random.randint(2,4)}*i*j",
+            f"{self.rng.randint(2,4)}*i*j",
             f"i^2 + j^2"
         ])
         
-        outer_end = random.randint(3, 5)  # Concrete value instead of n
-        inner_end = random.randint(4, 6)  # Concrete value instead of m
+        outer_end = self.rng.randint(3, 5)  # Concrete value instead of n
+        inner_end = self.rng.randint(4, 6)  # Concrete value instead of m
         
         return {
             "expression": expression,
@@ -41,15 +48,15 @@ class DoubleOperationGenerator:
         """Generate Level 2 double operation with varying signs"""
         # Generate random integer ranges instead of using variables
         ranges = [
-            random.randint(-5, -1) if random.choice([True, False]) else random.randint(1, 5)
+            self.rng.randint(-5, -1) if self.rng.choice([True, False]) else self.rng.randint(1, 5)
             for _ in range(4)
         ]
         
-        expression = random.choice([
+        expression = self.rng.choice([
             "i+j",
             "i^j",
             "2^(i+j)",
-            f"{random.randint(2,4)}*i^2 - j"
+            f"{self.rng.randint(2,4)}*i^2 - j"
         ])
         
         return {
@@ -65,13 +72,13 @@ class DoubleOperationGenerator:
     
     def generate_level3(self, operation_type: str = "summation") -> dict:
         """Generate Level 3 double operation with correlated indices"""
-        correlation = random.choice(["+", "-"])
-        offset = random.randint(1, 2)
-        outer_end = random.randint(3, 5)  # Concrete value
-        inner_end = random.randint(outer_end + 1, outer_end + 3)  # Ensure inner_end > outer_end
+        correlation = self.rng.choice(["+", "-"])
+        offset = self.rng.randint(1, 2)
+        outer_end = self.rng.randint(3, 5)  # Concrete value
+        inner_end = self.rng.randint(outer_end + 1, outer_end + 3)  # Ensure inner_end > outer_end
         
         inner_start = f"i{correlation}{offset}"  # Correlation with outer index
-        expression = random.choice([
+        expression = self.rng.choice([
             "i+j",
             "(i+j)^2"
         ])
@@ -89,17 +96,17 @@ class DoubleOperationGenerator:
     
     def generate_level4(self, operation_type: str = "summation") -> dict:
         """Generate Level 4 double operation with correlated indices and varying signs"""
-        correlation = random.choice(["+", "-"])
-        offset = random.randint(1, 2)
+        correlation = self.rng.choice(["+", "-"])
+        offset = self.rng.randint(1, 2)
         
         # Generate concrete integer ranges with different signs
-        outer_start = random.randint(-5, -1)
-        outer_end = random.randint(1, 5)
-        inner_end = random.randint(abs(outer_end) + 1, abs(outer_end) + 3)
+        outer_start = self.rng.randint(-5, -1)
+        outer_end = self.rng.randint(1, 5)
+        inner_end = self.rng.randint(abs(outer_end) + 1, abs(outer_end) + 3)
         
         inner_start = f"i{correlation}{offset}"  # Correlation with outer index
         
-        expression = random.choice([
+        expression = self.rng.choice([
             "i+j",
             "(i+j)^2"
         ])
@@ -116,23 +123,27 @@ class DoubleOperationGenerator:
         }
 
 class IndexRangeGenerator:
+    def __init__(self, rng=random):
+        self.rng = rng
+    
     def generate_range_for_level2(self, variation: str) -> Tuple[int, int]:
         """Generate concrete integer ranges for level 2"""
         if variation == "both_negative":
-            return (random.randint(-5, -3), random.randint(-2, -1))
+            return (self.rng.randint(-5, -3), self.rng.randint(-2, -1))
         elif variation == "m_positive_n_negative":
-            return (random.randint(1, 3), random.randint(-3, -1))
+            return (self.rng.randint(1, 3), self.rng.randint(-3, -1))
         else:  # m_negative_n_positive
-            return (random.randint(-3, -1), random.randint(1, 3))
+            return (self.rng.randint(-3, -1), self.rng.randint(1, 3))
             
     def generate_range_for_level3(self) -> Tuple[int, int]:
         """Generate concrete integer ranges for level 3"""
-        start = random.randint(-5, -1)
-        end = random.randint(start + 2, start + 5)
+        start = self.rng.randint(-5, -1)
+        end = self.rng.randint(start + 2, start + 5)
         return (start, end)
 
 class ExpressionGenerator:
-    def __init__(self):
+    def __init__(self, rng=random):
+        self.rng = rng
         self.functions = ['sqrt', 'ln']
     
     def generate_complex_expression(self, operation_type: str) -> str:
@@ -153,7 +164,7 @@ class ExpressionGenerator:
                 lambda: f"(2*i - 1)",
                 lambda: f"(i^2 - 3)"
             ]
-        return random.choice(expressions)()
+        return self.rng.choice(expressions)()
 
 def format_double_question(question: dict) -> str:
     """Format double operation questions in mathematical notation."""
@@ -201,24 +212,10 @@ def generate_distractors(expansion: str, operation_type: str) -> tuple[str, str]
     
     return distractor1, distractor2
 
-def generate_double_question_by_level(level: int, operation_type: str = "summation") -> dict:
+def generate_double_question_by_level(level: int, operation_type: str = "summation", rng=random) -> dict:
     """Generate a double operation question for the specified level"""
-    generator = DoubleOperationGenerator()
-    
-    # Convert symbolic bounds to actual integers
-    if level == 1:
-        question = generator.generate_level1(operation_type)
-        question['outer_end'] = random.randint(3, 5)  # Replace 'n' with concrete value
-        question['inner_end'] = random.randint(4, 6)  # Replace 'm' with concrete value
-        return question
-    elif level == 2:
-        return generator.generate_level2(operation_type)
-    elif level == 3:
-        return generator.generate_level3(operation_type)
-    elif level == 4:
-        return generator.generate_level4(operation_type)
-    else:
-        raise ValueError(f"Invalid level: {level}. Supported levels are 1-4")
+    problem = ProblemType.DOUBLE_SUM if operation_type == "summation" else ProblemType.DOUBLE_PRODUCT
+    return question_generator(rng).generate(problem, level)
 
 def format_single_question(question: dict) -> str:
     """Format single operation questions in mathematical notation"""
@@ -326,13 +323,14 @@ def format_question_katex(question: dict) -> str:
                 f"{symbols_sequence[2]}_{{k={question['inner_start']}}}^{{{question['inner_end']}}} ({expr})")
 
 class SingleOperationGenerator:
-    def __init__(self):
-        self.expr_gen = ExpressionGenerator()
-        self.range_gen = IndexRangeGenerator()
+    def __init__(self, rng=random):
+        self.rng = rng
+        self.expr_gen = ExpressionGenerator(rng)
+        self.range_gen = IndexRangeGenerator(rng)
     
     def generate_level1(self, operation_type: str = "summation") -> dict:
         """Generate Level 1 question with positive indices"""
-        n = random.randint(2, 5)  # Keeping n small for products
+        n = self.rng.randint(2, 5)  # Keeping n small for products
         return {
             "expression": "i",
             "start_index": 1,
@@ -343,7 +341,7 @@ class SingleOperationGenerator:
     
     def generate_level2(self, operation_type: str = "summation") -> dict:
         """Generate Level 2 question with varying signs"""
-        variation = random.choice([
+        variation = self.rng.choice([
             "both_negative",
             "m_positive_n_negative",
             "m_negative_n_positive"
@@ -368,7 +366,7 @@ class SingleOperationGenerator:
             m, n = self.range_gen.generate_range_for_level2_product()
         else:
             m, n = self.range_gen.generate_range_for_level2(
-                random.choice(["both_negative", "m_positive_n_negative", "m_negative_n_positive"])
+                self.rng.choice(["both_negative", "m_positive_n_negative", "m_negative_n_positive"])
             )
         
         expression = self.expr_gen.generate_complex_expression(operation_type)
@@ -380,61 +378,22 @@ class SingleOperationGenerator:
             "level": 3
         }
 
-def generate_question_by_level(level: int, operation_type: str = "summation") -> dict:
-    """Generate single, double, or triple operation questions based on the operation sequence."""
-    expr_gen = ExpressionGenerator()
-    
-    if level == 1:
-        # Level 1: Small positive integers
-        n = random.randint(3, 5)
-        return {
-            "outer_start": "1",
-            "outer_end": str(n),
-            "expression": "i",
-            "type": operation_type,
-            "operation_sequence": "S" if operation_type == "summation" else "P"
-        }
-    elif level == 2:
-        # Level 2: Mix of positive and negative integers
-        start = random.randint(-5, -1)
-        end = random.randint(1, 5)
-        return {
-            "outer_start": str(start),
-            "outer_end": str(end),
-            "expression": "i^2",
-            "type": operation_type,
-            "operation_sequence": "S" if operation_type == "summation" else "P"
-        }
-    else:  # level 3 or 4
-        # Level 3/4: Larger range of integers with complex expressions
-        if operation_type == "product":
-            # Keep range smaller for products to avoid huge numbers
-            start = random.randint(-4, -1)
-            end = random.randint(2, 4)
-        else:
-            # Larger range for summations
-            start = random.randint(-8, -3)
-            end = random.randint(3, 8)
-            
-        return {
-            "outer_start": str(start),
-            "outer_end": str(end),
-            "expression": expr_gen.generate_complex_expression(operation_type),
-            "type": operation_type,
-            "operation_sequence": "S" if operation_type == "summation" else "P"
-        }
+def generate_question_by_level(level: int, operation_type: str = "summation", rng=random) -> dict:
+    """Generate a single operation question for the specified level"""
+    return question_generator(rng).single(level, operation_type)
 
 class TripleOperationGenerator:
-    def __init__(self):
-        self.expr_gen = ExpressionGenerator()
-        self.range_gen = IndexRangeGenerator()
+    def __init__(self, rng=random):
+        self.rng = rng
+        self.expr_gen = ExpressionGenerator(rng)
+        self.range_gen = IndexRangeGenerator(rng)
     
     def generate_level1(self, operation_sequence: str) -> dict:
         """Generate Level 1 triple operation with positive indices."""
-        expression = random.choice([
+        expression = self.rng.choice([
             "i+j+k",
             "i^j*k",
-            f"{random.randint(2,3)}*i^2 - j + k"
+            f"{self.rng.randint(2,3)}*i^2 - j + k"
         ])
         
         return {
@@ -453,11 +412,11 @@ class TripleOperationGenerator:
     def generate_level2(self, operation_sequence: str) -> dict:
         """Generate Level 2 triple operation with mixed signs and independent indices."""
         ranges = [
-            random.randint(-5, -1) if random.choice([True, False]) else random.randint(1, 5)
+            self.rng.randint(-5, -1) if self.rng.choice([True, False]) else self.rng.randint(1, 5)
             for _ in range(6)
         ]
         
-        expression = random.choice([
+        expression = self.rng.choice([
             "i+j+k",
             "(i*j)/k",
             "(i-j)^k"
@@ -478,33 +437,33 @@ class TripleOperationGenerator:
     
     def generate_level3(self, operation_sequence: str) -> dict:
         """Generate Level 3 triple operation with correlated indices."""
-        correlation_type = random.choice(["two_indices", "all_indices"])
+        correlation_type = self.rng.choice(["two_indices", "all_indices"])
         
         if correlation_type == "two_indices":
             # Correlate two indices randomly
-            corr_pair = random.choice(["i_j", "i_k", "j_k"])
+            corr_pair = self.rng.choice(["i_j", "i_k", "j_k"])
             if corr_pair == "i_j":
-                middle_start = f"i+{random.randint(1,2)}"
+                middle_start = f"i+{self.rng.randint(1,2)}"
                 inner_start = "1"
             elif corr_pair == "i_k":
                 middle_start = "1"
-                inner_start = f"i-{random.randint(1,2)}"
+                inner_start = f"i-{self.rng.randint(1,2)}"
             else:  # j_k
                 middle_start = "1"
-                inner_start = f"j+{random.randint(1,2)}"
+                inner_start = f"j+{self.rng.randint(1,2)}"
         else:
             # Correlate all three indices
-            middle_start = f"i+{random.randint(1,2)}"
-            inner_start = f"j-{random.randint(1,2)}"
+            middle_start = f"i+{self.rng.randint(1,2)}"
+            inner_start = f"j-{self.rng.randint(1,2)}"
         
         return {
             "expression": "(i-j)^k",
-            "outer_start": str(random.randint(-2, 2)),
-            "outer_end": str(random.randint(3, 6)),
+            "outer_start": str(self.rng.randint(-2, 2)),
+            "outer_end": str(self.rng.randint(3, 6)),
             "middle_start": middle_start,
-            "middle_end": str(random.randint(4, 7)),
+            "middle_end": str(self.rng.randint(4, 7)),
             "inner_start": inner_start,
-            "inner_end": str(random.randint(5, 8)),
+            "inner_end": str(self.rng.randint(5, 8)),
             "operation_sequence": operation_sequence,
             "level": 3,
             "correlated": True
@@ -531,18 +490,9 @@ def format_triple_question(question: dict) -> str:
             f"^{{{question['inner_end']}}} "
             f"{question['expression']}")
 
-def generate_triple_question(operation_sequence: str, level: int) -> dict:
+def generate_triple_question(operation_sequence: str, level: int, rng=random) -> dict:
     """Generate a triple operation question with specified operation sequence and level."""
-    generator = TripleOperationGenerator()
-    
-    if level == 1:
-        return generator.generate_level1(operation_sequence)
-    elif level == 2:
-        return generator.generate_level2(operation_sequence)
-    elif level == 3:
-        return generator.generate_level3(operation_sequence)
-    else:
-        raise ValueError(f"Invalid level: {level}. Supported levels are 1-3")
+    return question_generator(rng).generate(_PROBLEMS_BY_SEQUENCE[operation_sequence], level)
 
 class ProblemType(Enum):
     SINGLE_SUM = 1
@@ -560,25 +510,29 @@ class ProblemType(Enum):
     PRODUCT_SUM_PRODUCT = 13
     PRODUCT_PRODUCT_SUM = 14
 
+# Operation sequence of each problem type, per the design document
+PROBLEM_SEQUENCES = {
+    ProblemType.SINGLE_SUM: "S",              # \sum
+    ProblemType.SINGLE_PRODUCT: "P",          # \prod
+    ProblemType.DOUBLE_SUM: "SS",             # \sum \sum
+    ProblemType.DOUBLE_PRODUCT: "PP",         # \prod \prod
+    ProblemType.SUM_PRODUCT: "SP",            # \sum \prod
+    ProblemType.PRODUCT_SUM: "PS",            # \prod \sum
+    ProblemType.TRIPLE_SUM: "SSS",            # \sum \sum \sum
+    ProblemType.TRIPLE_PRODUCT: "PPP",        # \prod \prod \prod
+    ProblemType.DOUBLE_SUM_PRODUCT: "SSP",    # \sum \sum \prod
+    ProblemType.SUM_PRODUCT_SUM: "SPS",       # \sum \prod \sum
+    ProblemType.SUM_DOUBLE_PRODUCT: "SPP",    # \sum \prod \prod
+    ProblemType.PRODUCT_SUM_SUM: "PSS",       # \prod \sum \sum
+    ProblemType.PRODUCT_SUM_PRODUCT: "PSP",   # \prod \sum \prod
+    ProblemType.PRODUCT_PRODUCT_SUM: "PPS",   # \prod \prod \sum
+}
+_SEQUENCES_BY_NUMBER = {problem.value: sequence for problem, sequence in PROBLEM_SEQUENCES.items()}
+_PROBLEMS_BY_SEQUENCE = {sequence: problem for problem, sequence in PROBLEM_SEQUENCES.items()}
+
 def get_operation_sequence(prob_number: int) -> str:
     """Convert problem number to operation sequence based on the design document."""
-    sequences = {
-        1: "S",      # \sum
-        2: "P",      # \prod
-        3: "SS",     # \sum \sum
-        4: "PP",     # \prod \prod
-        5: "SP",     # \sum \prod
-        6: "PS",     # \prod \sum
-        7: "SSS",    # \sum \sum \sum
-        8: "PPP",    # \prod \prod \prod
-        9: "SSP",    # \sum \sum \prod
-        10: "SPS",   # \sum \prod \sum
-        11: "SPP",   # \sum \prod \prod
-        12: "PSS",   # \prod \sum \sum
-        13: "PSP",   # \prod \sum \prod
-        14: "PPS"    # \prod \prod \sum
-    }
-    return sequences.get(prob_number, "")
+    return _SEQUENCES_BY_NUMBER.get(prob_number, "")
 
 def evaluate_expression(expr: str, vars: dict) -> float:
     """Evaluate a mathematical expression with given variables"""
@@ -604,58 +558,453 @@ def evaluate_expression(expr: str, vars: dict) -> float:
     except:
         return 0  # Return 0 for invalid expressions
 
-def generate_expansion(question: dict) -> str:
-    """Generate the expansion based on the operation sequence"""
+_EXPR_TOKEN = re.compile(r'\s*(?:(\d+(?:\.\d*)?)|([A-Za-z_]\w*)|(\*\*|[-+*/^()]))')
+_INDEX_VARIABLES = ('i', 'j', 'k')
+_EXPR_FUNCTIONS = {'sqrt': math.sqrt, 'ln': math.log}
+
+def tokenize_expression(expr: str) -> List[str]:
+    """Split an expression such as "(2*i - 1)/i" into number, name and operator tokens"""
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = _EXPR_TOKEN.match(expr, pos)
+        if not match:
+            raise ValueError(f"Unexpected character {expr[pos]!r} in expression {expr!r}")
+        tokens.append(match.group(match.lastindex))
+        pos = match.end()
+    return tokens
+
+class ExpressionParser:
+    """Recursive-descent parser for the expression grammar the generators emit.
+
+    expr  := term (('+' | '-') term)*
+    term  := unary (('*' | '/') unary)*
+    unary := '-' unary | power
+    power := atom ('^' unary)?
+    atom  := NUMBER | INDEX | FUNCTION '(' expr ')' | '(' expr ')'
+
+    Nodes are tuples: ('num', value), ('var', name), ('neg', operand),
+    ('bin', op, left, right) and ('call', name, argument).
+    """
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        self.tokens = tokenize_expression(expr)
+        self.pos = 0
+
+    def parse(self) -> tuple:
+        node = self.parse_expr()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"Unexpected token {self.tokens[self.pos]!r} in expression {self.expr!r}")
+        return node
+
+    def peek(self) -> str:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected: str = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError(f"Expected {expected or 'a token'} in expression {self.expr!r}")
+        self.pos += 1
+        return token
+
+    def parse_expr(self) -> tuple:
+        node = self.parse_term()
+        while self.peek() in ('+', '-'):
+            op = self.take()
+            node = ('bin', op, node, self.parse_term())
+        return node
+
+    def parse_term(self) -> tuple:
+        node = self.parse_unary()
+        while self.peek() in ('*', '/'):
+            op = self.take()
+            node = ('bin', op, node, self.parse_unary())
+        return node
+
+    def parse_unary(self) -> tuple:
+        if self.peek() == '-':
+            self.take()
+            return ('neg', self.parse_unary())
+        return self.parse_power()
+
+    def parse_power(self) -> tuple:
+        node = self.parse_atom()
+        if self.peek() in ('^', '**'):
+            self.take()
+            node = ('bin', '^', node, self.parse_unary())
+        return node
+
+    def parse_atom(self) -> tuple:
+        token = self.take()
+        if token == '(':
+            node = self.parse_expr()
+            self.take(')')
+            return node
+        if token[0].isdigit():
+            return ('num', float(token) if '.' in token else int(token))
+        if token in _INDEX_VARIABLES:
+            return ('var', token)
+        if token in _EXPR_FUNCTIONS:
+            self.take('(')
+            argument = self.parse_expr()
+            self.take(')')
+            return ('call', token, argument)
+        raise ValueError(f"Unknown name {token!r} in expression {self.expr!r}")
+
+def expression_to_python(node: tuple) -> str:
+    """Render a parsed expression as fully parenthesised Python source"""
+    kind = node[0]
+    if kind == 'num':
+        return repr(node[1])
+    if kind == 'var':
+        return node[1]
+    if kind == 'neg':
+        return f"(-{expression_to_python(node[1])})"
+    if kind == 'call':
+        return f"{node[1]}({expression_to_python(node[2])})"
+    op = '**' if node[1] == '^' else node[1]
+    return f"({expression_to_python(node[2])} {op} {expression_to_python(node[3])})"
+
+def expression_has_calls(node: tuple) -> bool:
+    """Whether a parsed expression applies sqrt or ln anywhere"""
+    kind = node[0]
+    if kind == 'call':
+        return True
+    if kind == 'neg':
+        return expression_has_calls(node[1])
+    if kind == 'bin':
+        return expression_has_calls(node[2]) or expression_has_calls(node[3])
+    return False
+
+class CompiledExpression:
+    """An expression parsed once and callable over the index values (i, j, k)"""
+    __slots__ = ('source', 'ast', 'variables', 'symbolic', '_function', '_template')
+
+    def __init__(self, source: str):
+        self.source = source
+        self.ast = ExpressionParser(source).parse()
+        self.variables = frozenset(re.findall(r'\b[ijk]\b', source))
+        # Expansions show sqrt/ln terms with the indices written in rather than as decimals
+        self.symbolic = expression_has_calls(self.ast)
+        self._function = eval(
+            f"lambda i=0, j=0, k=0: {expression_to_python(self.ast)}",
+            {'__builtins__': {}, **_EXPR_FUNCTIONS}
+        )
+        # Only whole index names are substituted, so 'ln' or 'sqrt' are left intact
+        escaped = source.replace('{', '{{').replace('}', '}}')
+        self._template = re.sub(r'\b([ijk])\b', r'{\1}', escaped)
+
+    def __call__(self, i=0, j=0, k=0):
+        return self._function(i, j, k)
+
+    def substitute(self, i=0, j=0, k=0) -> str:
+        """The expression text with the index values written in, e.g. "ln(2+3)" """
+        return self._template.format(i=i, j=j, k=k)
+
+@lru_cache(maxsize=256)
+def compile_expression(expr: str) -> CompiledExpression:
+    """Parse and compile an expression once; repeated calls hit the LRU cache"""
+    return CompiledExpression(expr)
+
+# Integers beyond this are not exactly representable as float64
+_EXACT_INT_LIMIT = 2.0 ** 53
+# Grids with fewer cells are evaluated cell by cell: NumPy's fixed per-call cost
+# only pays off above roughly this size, and most generated grids hold 3-50 cells
+_VECTORIZE_MIN_CELLS = 192
+
+def index_range(start: int, end: int) -> np.ndarray:
+    """NumPy counterpart of get_range(), including descending ranges"""
+    step = 1 if start <= end else -1
+    return np.arange(start, end + step, step, dtype=np.int64)
+
+def _int_zero(values, is_float):
+    """Python ints have no negative zero, so -0.0 in an int cell becomes 0.0"""
+    return np.where(is_float, values, values + 0.0)
+
+def _evaluate_grid_node(node: tuple, env: dict) -> tuple:
+    """Evaluate a parsed expression over index arrays.
+
+    Returns (values, is_float, masked): float64 values, whether Python would
+    produce a float rather than an int for each cell, and the cells whose value
+    is undefined or not exactly representable.
+    """
+    kind = node[0]
+    if kind == 'num':
+        return np.float64(node[1]), isinstance(node[1], float), False
+    if kind == 'var':
+        return env[node[1]], False, False
+    if kind == 'call':
+        # sqrt/ln terms are rendered symbolically by the scalar path
+        return np.float64('nan'), True, True
+    if kind == 'neg':
+        values, is_float, masked = _evaluate_grid_node(node[1], env)
+        return _int_zero(-values, is_float), is_float, masked
+
+    op = node[1]
+    a, a_float, a_masked = _evaluate_grid_node(node[2], env)
+    b, b_float, b_masked = _evaluate_grid_node(node[3], env)
+    masked = a_masked | b_masked
+    with np.errstate(all='ignore'):
+        if op == '+':
+            values, is_float = a + b, a_float | b_float
+        elif op == '-':
+            values, is_float = a - b, a_float | b_float
+        elif op == '*':
+            values, is_float = a * b, a_float | b_float
+        elif op == '/':
+            zero = b == 0
+            masked = masked | zero
+            values, is_float = a / np.where(zero, 1.0, b), True
+        else:
+            # int ** negative int is a float; 0 ** negative raises; a negative
+            # base with a fractional exponent gives a complex number. NumPy's pow
+            # is not correctly rounded, so float powers (e.g. 5 ** -5) are left to
+            # the scalar path; int ** non-negative int is exact in both
+            values, is_float = np.power(a, b), a_float | b_float | (b < 0)
+            masked = masked | is_float | ((a < 0) & (b != np.floor(b)))
+        masked = masked | ~np.isfinite(values) | (~is_float & (np.abs(values) >= _EXACT_INT_LIMIT))
+    return _int_zero(values, is_float), is_float, masked
+
+def evaluate_grid(compiled: CompiledExpression, i=0, j=0, k=0) -> tuple:
+    """Evaluate a compiled expression over broadcastable index arrays in one pass.
+
+    Returns (values, is_float, masked) arrays of the broadcast shape; masked
+    cells (division by zero, overflow, values too large for float64) must be
+    evaluated with the scalar compiled function instead.
+    """
+    env = {name: np.asarray(value, dtype=np.float64) for name, value in zip(_INDEX_VARIABLES, (i, j, k))}
+    values, is_float, masked = _evaluate_grid_node(compiled.ast, env)
+    shape = np.broadcast_shapes(*(array.shape for array in env.values()))
+    return (np.broadcast_to(values, shape),
+            np.broadcast_to(is_float, shape),
+            np.broadcast_to(masked, shape))
+
+def render_grid_terms(compiled: CompiledExpression, scalar_term, format_value=str, i=0, j=0, k=0,
+                      scalar_floats: bool = False) -> List[str]:
+    """Evaluate over an index grid and render every cell as a term string, in C order.
+
+    Exact cells are rendered from the arrays with format_value; masked cells are
+    rendered by scalar_term(i, j, k) so undefined values keep the caller's fallback.
+    With scalar_floats, non-integer cells go to scalar_term as well. Grids below
+    _VECTORIZE_MIN_CELLS are rendered by scalar_term alone.
+    """
+    shape = np.broadcast_shapes(np.shape(i), np.shape(j), np.shape(k))
+    if math.prod(shape) < _VECTORIZE_MIN_CELLS:
+        columns = [np.broadcast_to(index, shape).ravel().tolist() for index in (i, j, k)]
+        return render_scalar_terms(compiled, scalar_term, zip(*columns))
+    
+    values, is_float, masked = evaluate_grid(compiled, i, j, k)
+    if scalar_floats:
+        masked = masked | is_float
+    ints = np.where(is_float | masked, 0, values).astype(np.int64).ravel().tolist()
+    if not masked.any() and not is_float.any():
+        return list(map(str, ints))
+
+    floats = values.ravel().tolist()
+    is_float = is_float.ravel().tolist()
+    masked_cells = masked.ravel().tolist()
+    indices = [array.ravel().tolist() for array in np.broadcast_arrays(i, j, k)]
+    terms = []
+    for cell, masked_cell in enumerate(masked_cells):
+        if masked_cell:
+            terms.append(scalar_term(indices[0][cell], indices[1][cell], indices[2][cell]))
+        elif is_float[cell]:
+            terms.append(format_value(floats[cell]))
+        else:
+            terms.append(str(ints[cell]))
+    return terms
+
+def render_scalar_terms(compiled: CompiledExpression, scalar_term, cells) -> List[str]:
+    """render_grid_terms() cell by cell for small grids.
+
+    Integer terms read the same in every notation, so they are written
+    directly; anything else goes to scalar_term(i, j, k).
+    """
+    terms = []
+    for cell in cells:
+        try:
+            value = compiled(*cell)
+        except (ArithmeticError, ValueError):
+            value = None
+        terms.append(str(value) if type(value) is int else scalar_term(*cell))
+    return terms
+
+def evaluate_start_indices(expr, i=0, j=0) -> np.ndarray:
+    """Vectorized calculate_start_index() over arrays of outer index values"""
+    shape = np.broadcast_shapes(np.shape(i), np.shape(j))
+    if math.prod(shape) < _VECTORIZE_MIN_CELLS:
+        columns = [np.broadcast_to(index, shape).ravel().tolist() for index in (i, j)]
+        starts = [calculate_start_index(expr, *cell) for cell in zip(*columns)]
+        return np.array(starts, dtype=np.int64).reshape(shape)
+    compiled = compile_expression(str(expr))
+    values, _, masked = evaluate_grid(compiled, i, j)
+    starts = np.trunc(np.where(masked, 0, values)).astype(np.int64)
+    if masked.any():
+        i_values, j_values = np.broadcast_arrays(i, j)
+        for cell in zip(*np.nonzero(masked)):
+            starts[cell] = calculate_start_index(expr, i=int(i_values[cell]), j=int(j_values[cell]))
+    return starts
+
+def ragged_index_range(starts: np.ndarray, end: int) -> tuple:
+    """Concatenate get_range(start, end) for every start in one pass.
+
+    Returns (indices, row_pointers) in CSR layout: row r of the ragged space is
+    indices[row_pointers[r]:row_pointers[r + 1]].
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.abs(end - starts) + 1
+    row_pointers = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=row_pointers[1:])
+    steps = np.where(starts <= end, 1, -1)
+    positions = np.arange(row_pointers[-1], dtype=np.int64) - np.repeat(row_pointers[:-1], lengths)
+    return np.repeat(starts, lengths) + positions * np.repeat(steps, lengths), row_pointers
+
+def split_rows(items: list, row_pointers: np.ndarray) -> list:
+    """Regroup a flat list into the rows described by CSR row pointers"""
+    bounds = row_pointers.tolist() if isinstance(row_pointers, np.ndarray) else row_pointers
+    return [items[start:stop] for start, stop in zip(bounds, bounds[1:])]
+
+class TermLeaf:
+    """A single evaluated term, e.g. "12", "0.5" or "ln(2+3)" """
+    __slots__ = ('value',)
+
+    def __init__(self, value: str):
+        self.value = value
+
+class UndefinedTerm:
+    """Marker for a term that could not be evaluated; walkers skip it"""
+    __slots__ = ()
+
+UNDEFINED = UndefinedTerm()
+
+class TermGroup:
+    """Terms combined by one operator, 'S' (+) or 'P' (\\cdot)"""
+    __slots__ = ('operator', 'children')
+
+    def __init__(self, operator: str, children: list):
+        self.operator = operator
+        self.children = children
+
+    def defined_children(self) -> list:
+        return [child for child in self.children if child is not UNDEFINED]
+
+_GROUP_JOINERS = {'S': ' + ', 'P': ' \\cdot '}
+
+def term_leaves(terms: List[str]) -> list:
+    """Wrap rendered term strings as leaves, marking "undefined" ones"""
+    return [UNDEFINED if term == "undefined" else TermLeaf(term) for term in terms]
+
+def render_term_tree(node, format_leaf=None) -> str:
+    """Render a term tree in one walk; groups of several terms are parenthesised"""
+    if isinstance(node, TermLeaf):
+        return format_leaf(node.value) if format_leaf else node.value
+    children = node.defined_children()
+    if not children:
+        return get_empty_value(node.operator)
+    # Leaves are rendered inline; most children are leaves of an innermost group
+    result = _GROUP_JOINERS[node.operator].join([
+        (format_leaf(child.value) if format_leaf else child.value) if type(child) is TermLeaf
+        else render_term_tree(child, format_leaf)
+        for child in children
+    ])
+    return f"({result})" if len(children) > 1 else result
+
+ELIDED = TermLeaf('\\cdots')  # stands in for the terms a folded group leaves out
+
+def fold_term_tree(node, fold: int):
+    """Materialize what a folded rendering shows, in one pass over a (possibly streamed) tree.
+
+    Any group with more than 2 * fold terms keeps only its first and last fold
+    terms around ELIDED, and undefined terms are dropped. Children are consumed
+    as a stream, so only 2 * fold of them are held at once; the result is a
+    plain tree that every renderer can walk again without re-evaluating it.
+    """
+    if isinstance(node, TermLeaf):
+        return node
+    head, tail, count = [], deque(maxlen=fold), 0
+    for child in node.children:
+        if child is UNDEFINED:
+            continue
+        count += 1
+        if len(head) < fold:
+            head.append(fold_term_tree(child, fold))
+        else:
+            tail.append(child)
+    children = head + ([ELIDED] if count > 2 * fold else [])
+    children.extend(fold_term_tree(child, fold) for child in tail)
+    return TermGroup(node.operator, children)
+
+# Exact rational terms as written by format_exact_value(), e.g. "-7/2"
+_EXACT_FRACTION = re.compile(r'(-?)(\d+)/([1-9]\d*)')
+
+@lru_cache(maxsize=1024)
+def format_leaf_katex(value: str) -> str:
+    """KaTeX form of a single term: 3-decimal numbers, braced exponents, \\cdot"""
+    fraction = _EXACT_FRACTION.fullmatch(value)
+    if fraction:
+        return f"{fraction.group(1)}\\frac{{{fraction.group(2)}}}{{{fraction.group(3)}}}"
+    value = format_decimal(value)
+    if '^' in value:
+        value = re.sub(r'\^(-?\d+)', r'^{\1}', value)
+    return value.replace('*', '\\cdot')
+
+def term_tree_to_text(node, fold: int = None) -> str:
+    """Plain-text expansion, e.g. "((1 + 2) + (2 + 3))"; fold elides long groups"""
+    return render_term_tree(fold_term_tree(node, fold) if fold else node)
+
+def term_tree_to_katex(node, fold: int = None) -> str:
+    """KaTeX expansion rendered straight from the tree; fold elides long groups"""
+    return render_term_tree(fold_term_tree(node, fold) if fold else node, format_leaf_katex)
+
+def generate_expansion(question: dict, exact: bool = False) -> TermGroup:
+    """Generate the expansion tree based on the operation sequence.
+
+    With exact, non-integer terms are exact fractions such as "7/2" rather
+    than floats.
+    """
+    space = small_index_space(question)
+    if space is not None:
+        # Few enough terms to build and evaluate cell by cell
+        return expand_small_spaces([question], [space], {}, exact)[0]
+    
     # Get operation sequence
     ops = question.get('operation_sequence', '')
     
     # Handle single operations
     if not ops or len(ops) == 1:
-        return expand_single_operation(question)
+        return expand_single_operation(question, exact)
     # Handle double operations
     elif len(ops) == 2:
-        return expand_double_operation(question)
+        return expand_double_operation(question, exact)
     # Handle triple operations
     else:
-        return expand_triple_operation(question)
+        return expand_triple_operation(question, exact)
 
 
-def expand_single_operation(question: dict) -> str:
+def expand_single_operation(question: dict, exact: bool = False) -> TermGroup:
     """Expand a single operation expression."""
     start = int(question['outer_start'])
     end = int(question['outer_end'])
     expression = question['expression']
     operation_type = question.get('type', 'summation')
     
-    def evaluate_term(expr: str, i: int) -> str:
+    compiled = compile_expression(expression)
+    
+    def evaluate_term(i: int) -> str:
         """Evaluate a term with the given index."""
-        term = expr.replace('i', str(i))
+        if compiled.symbolic:
+            return compiled.substitute(i)
         try:
-            # Replace ^ with ** for Python evaluation
-            eval_term = term.replace('^', '**')
-            result = str(eval(eval_term))
-            return result
-        except:
-            return term
+            return format_exact_value(exact_term(expression, i)) if exact else str(compiled(i))
+        except (ArithmeticError, ValueError):
+            return compiled.substitute(i)
     
-    terms = []
-    for i in get_range(start, end):
-        term = evaluate_term(expression, i)
-        terms.append(term)
-    
-    # Join terms with the appropriate operator
-    if operation_type == 'product':
-        operator = ' \\cdot '
-        result = operator.join(terms) if terms else "1"
-    else:
-        operator = ' + '
-        result = operator.join(terms) if terms else "0"
+    terms = render_grid_terms(compiled, lambda i, j, k: evaluate_term(i), i=index_range(start, end),
+                              scalar_floats=exact)
     
-    # Add parentheses if multiple terms
-    if len(terms) > 1:
-        result = f"({result})"
-    
-    return result
+    return TermGroup('P' if operation_type == 'product' else 'S', term_leaves(terms))
 
 def format_power_term(base: str, exponent: str) -> str:
     """Format a power expression with proper handling of negative exponents"""
@@ -681,7 +1030,7 @@ def evaluate_expression(expr: str, vars: dict) -> float:
     except:
         return 0  # Return 0 for invalid expressions
 
-def expand_double_operation(question: dict) -> str:
+def expand_double_operation(question: dict, exact: bool = False) -> TermGroup:
     """Expand a double operation expression."""
     outer_start = int(question['outer_start'])
     outer_end = int(question['outer_end'])
@@ -690,57 +1039,33 @@ def expand_double_operation(question: dict) -> str:
     expression = question['expression']
     ops = question.get('operation_sequence', 'SS')  # e.g., 'SP', 'PS', etc.
     
-    def evaluate_term(expr: str, i: int, j: int) -> str:
-        """Evaluate a term with the given indices."""
-        term = expr.replace('i', str(i)).replace('j', str(j))
-        try:
-            # Replace ^ with ** for Python evaluation
-            eval_term = term.replace('^', '**')
-            result = str(eval(eval_term))
-            return result
-        except:
-            return term
+    compiled = compile_expression(expression)
     
-    outer_terms = []
-    for i in get_range(outer_start, outer_end):
-        inner_terms = []
-        
-        # Calculate actual inner start for correlated indices
+    def evaluate_term(i: int, j: int) -> str:
+        """Evaluate a term with the given indices."""
+        if compiled.symbolic:
+            return compiled.substitute(i, j)
         try:
-            if isinstance(inner_start, str) and 'i' in inner_start:
-                actual_inner_start = eval(inner_start.replace('i', str(i)))
-            else:
-                actual_inner_start = int(inner_start)
-        except:
-            actual_inner_start = int(inner_start)
-        
-        for j in get_range(actual_inner_start, inner_end):
-            term = evaluate_term(expression, i, j)
-            inner_terms.append(term)
-        
-        # Combine inner terms based on inner operation
-        if ops[1] == 'P':
-            inner_result = ' \\cdot '.join(inner_terms) if inner_terms else "1"
-        else:
-            inner_result = ' + '.join(inner_terms) if inner_terms else "0"
-        
-        # Add parentheses if multiple terms
-        if len(inner_terms) > 1:
-            inner_result = f"({inner_result})"
-        
-        outer_terms.append(inner_result)
-    
-    # Combine outer terms based on outer operation
-    if ops[0] == 'P':
-        result = ' \\cdot '.join(outer_terms) if outer_terms else "1"
+            return format_exact_value(exact_term(expression, i, j)) if exact else str(compiled(i, j))
+        except (ArithmeticError, ValueError):
+            return compiled.substitute(i, j)
+    
+    outer_indices = index_range(outer_start, outer_end)
+    if compile_expression(str(inner_start)).variables:
+        # Correlated bounds: build every (i, j) pair of the ragged space at once
+        inner_indices, rows = ragged_index_range(evaluate_start_indices(inner_start, i=outer_indices), inner_end)
+        terms = render_grid_terms(compiled, lambda i, j, k: evaluate_term(i, j),
+                                  i=np.repeat(outer_indices, np.diff(rows)), j=inner_indices, scalar_floats=exact)
+        term_groups = split_rows(terms, rows)
     else:
-        result = ' + '.join(outer_terms) if outer_terms else "0"
-    
-    # Add parentheses if multiple outer terms
-    if len(outer_terms) > 1:
-        result = f"({result})"
-    
-    return result
+        # Independent bounds: evaluate the whole i x j rectangle at once
+        inner_indices = index_range(calculate_start_index(inner_start), inner_end)
+        terms = render_grid_terms(compiled, lambda i, j, k: evaluate_term(i, j),
+                                  i=outer_indices[:, None], j=inner_indices[None, :], scalar_floats=exact)
+        width = len(inner_indices)
+        term_groups = [terms[row * width:(row + 1) * width] for row in range(len(outer_indices))]
+    
+    return TermGroup(ops[0], [TermGroup(ops[1], term_leaves(inner_terms)) for inner_terms in term_groups])
 
 def get_range(start: int, end: int) -> range:
     """Generate a range that handles both ascending and descending sequences."""
@@ -757,33 +1082,22 @@ def get_empty_value(operation: str) -> str:
     """Get the identity value for an operation"""
     return "1" if operation == 'P' else "0"
 
-def evaluate_term(expr: str, i: int, j: int, k: int = None) -> str:
+def evaluate_term(expr: str, i: int, j: int, k: int = None, exact: bool = False) -> str:
     """Evaluate a term with given values"""
     try:
-        # Replace variables with values
-        term = expr.replace('i', str(i)).replace('j', str(j))
-        if k is not None:
-            term = term.replace('k', str(k))
-        
-        # Handle division
-        if '/' in term:
-            num, den = term.split('/')
-            num = num.strip('()')
-            den = den.strip('()')
-            if eval(den) == 0:  # Check for division by zero
-                return "undefined"
-            term = f"({num})/({den})"
-        
-        # Replace ^ with ** for Python evaluation
-        eval_term = term.replace('^', '**')
-        result = eval(eval_term)
-        
+        compiled = compile_expression(expr)
+        if compiled.symbolic:
+            return "undefined"
+        if exact:
+            return format_exact_value(exact_term(expr, i, j, 0 if k is None else k))
+        result = compiled(i, j, 0 if k is None else k)
         # Format decimal result
         return format_decimal(str(result))
-    except:
+    except (ArithmeticError, ValueError):
+        # Division by zero, overflow or a value outside a function's domain
         return "undefined"
 
-def expand_triple_operation(question: dict) -> str:
+def expand_triple_operation(question: dict, exact: bool = False) -> TermGroup:
     """Expand a triple operation expression with proper range handling."""
     outer_start = int(question['outer_start'])
     outer_end = int(question['outer_end'])
@@ -794,69 +1108,808 @@ def expand_triple_operation(question: dict) -> str:
     expression = question['expression']
     ops = question['operation_sequence']  # e.g., 'SSP', 'SPS', etc.
     
-    outer_terms = []
-    for i in get_range(outer_start, outer_end):
-        # Calculate actual middle start for correlated indices
+    compiled = compile_expression(expression)
+    term_format = lambda value: format_decimal(str(value))
+    outer_indices = index_range(outer_start, outer_end)
+    
+    if compile_expression(str(middle_start)).variables or compile_expression(str(inner_start)).variables:
+        # Correlated bounds: build every (i, j, k) tuple of the ragged space at once
+        middle_indices, middle_rows = ragged_index_range(
+            evaluate_start_indices(middle_start, i=outer_indices), middle_end)
+        outer_repeated = np.repeat(outer_indices, np.diff(middle_rows))
+        inner_indices, inner_rows = ragged_index_range(
+            evaluate_start_indices(inner_start, i=outer_repeated, j=middle_indices), inner_end)
+        inner_lengths = np.diff(inner_rows)
+        terms = render_grid_terms(compiled, lambda i, j, k: evaluate_term(expression, i, j, k, exact), term_format,
+                                  np.repeat(outer_repeated, inner_lengths), np.repeat(middle_indices, inner_lengths),
+                                  inner_indices, scalar_floats=exact)
+        term_groups = split_rows(split_rows(terms, inner_rows), middle_rows)
+    else:
+        # Independent bounds: evaluate the whole i x j x k box at once
+        middle_indices = index_range(calculate_start_index(middle_start), middle_end)
+        inner_indices = index_range(calculate_start_index(inner_start), inner_end)
+        terms = render_grid_terms(compiled, lambda i, j, k: evaluate_term(expression, i, j, k, exact), term_format,
+                                  outer_indices[:, None, None], middle_indices[None, :, None],
+                                  inner_indices[None, None, :], scalar_floats=exact)
+        depth, width = len(inner_indices), len(middle_indices)
+        term_groups = [
+            [terms[(row * width + column) * depth:(row * width + column + 1) * depth] for column in range(width)]
+            for row in range(len(outer_indices))
+        ]
+    
+    return TermGroup(ops[0], [
+        TermGroup(ops[1], [TermGroup(ops[2], term_leaves(inner_terms)) for inner_terms in middle_groups])
+        for middle_groups in term_groups
+    ])
+
+_STREAM_CHUNK = 4096  # indices evaluated per vectorized call when streaming a row
+
+class TermStream:
+    """Re-iterable children of a group, produced on demand from a factory"""
+    __slots__ = ('factory',)
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __iter__(self):
+        return self.factory()
+
+def iter_index_chunks(start: int, end: int, chunk_size: int = _STREAM_CHUNK):
+    """Yield get_range(start, end) as NumPy arrays of at most chunk_size indices"""
+    step = 1 if start <= end else -1
+    stop = end + step
+    for chunk_start in range(start, stop, step * chunk_size):
+        chunk_stop = chunk_start + step * chunk_size
+        chunk_stop = min(chunk_stop, stop) if step > 0 else max(chunk_stop, stop)
+        yield np.arange(chunk_start, chunk_stop, step, dtype=np.int64)
+
+def stream_row_terms(compiled: CompiledExpression, scalar_term, format_value, start: int, end: int, indices: dict,
+                     exact: bool = False):
+    """Yield the leaves of one innermost row, evaluating it chunk by chunk"""
+    name = _INDEX_VARIABLES[len(indices)]
+    for chunk in iter_index_chunks(start, end):
+        yield from term_leaves(render_grid_terms(compiled, scalar_term, format_value, **indices, **{name: chunk},
+                                                 scalar_floats=exact))
+
+def expansion_term_renderers(expression: str, depth: int, exact: bool = False) -> tuple:
+    """(scalar_term, format_value) for render_grid_terms() over an expansion of the given depth.
+
+    Triple expansions mark unevaluable terms "undefined" and round floats with
+    format_decimal(); single and double ones write the indices into the
+    expression instead.
+    """
+    if depth == 3:
+        return (lambda i, j, k: evaluate_term(expression, i, j, k, exact)), (lambda value: format_decimal(str(value)))
+    compiled = compile_expression(expression)
+    
+    def scalar_term(i: int, j: int = 0, k: int = 0) -> str:
+        if compiled.symbolic:
+            return compiled.substitute(i, j)
         try:
-            if isinstance(middle_start, str):
-                actual_middle_start = calculate_start_index(middle_start, i=i)
-            else:
-                actual_middle_start = int(middle_start)
-        except:
-            actual_middle_start = int(middle_start)
-        
-        middle_terms = []
-        for j in get_range(actual_middle_start, middle_end):
-            # Calculate actual inner start for correlated indices
-            try:
-                if isinstance(inner_start, str):
-                    actual_inner_start = calculate_start_index(inner_start, i=i, j=j)
-                else:
-                    actual_inner_start = int(inner_start)
-            except:
-                actual_inner_start = int(inner_start)
-            
-            inner_terms = []
-            for k in get_range(actual_inner_start, inner_end):
-                term = evaluate_term(expression, i, j, k)
-                if term != "undefined":
-                    inner_terms.append(term)
-            
-            # Combine inner terms based on inner operation
-            if ops[2] == 'P':
-                inner_result = ' \\cdot '.join(inner_terms) if inner_terms else "1"
-            else:
-                inner_result = ' + '.join(inner_terms) if inner_terms else "0"
-            
-            # Add parentheses if multiple terms
-            if len(inner_terms) > 1:
-                inner_result = f"({inner_result})"
-            
-            middle_terms.append(inner_result)
-        
-        # Combine middle terms based on middle operation
-        if ops[1] == 'P':
-            middle_result = ' \\cdot '.join(middle_terms) if middle_terms else "1"
-        else:
-            middle_result = ' + '.join(middle_terms) if middle_terms else "0"
-        
-        # Add parentheses if multiple terms
-        if len(middle_terms) > 1:
-            middle_result = f"({middle_result})"
-        
-        outer_terms.append(middle_result)
+            return format_exact_value(exact_term(expression, i, j)) if exact else str(compiled(i, j))
+        except (ArithmeticError, ValueError):
+            return compiled.substitute(i, j)
     
-    # Combine outer terms based on outer operation
-    if ops[0] == 'P':
-        result = ' \\cdot '.join(outer_terms) if outer_terms else "1"
+    return scalar_term, str
+
+def stream_expansion(question: dict, exact: bool = False) -> TermGroup:
+    """Lazy counterpart of generate_expansion().
+
+    Every group's children are a TermStream, so no row is evaluated until a
+    walker iterates it and memory stays bounded by _STREAM_CHUNK. Rendering
+    the stream gives the same text as the eager expansion.
+    """
+    ops = question_operators(question)
+    bounds = question_bounds(question)
+    compiled = compile_expression(question['expression'])
+    scalar_term, format_value = expansion_term_renderers(question['expression'], len(bounds), exact)
+    
+    def children(depth: int, indices: dict) -> TermStream:
+        name, start_key, end_key = bounds[depth]
+        start = calculate_start_index(question[start_key], **indices)
+        end = int(question[end_key])
+        if depth == len(bounds) - 1:
+            return TermStream(lambda: stream_row_terms(compiled, scalar_term, format_value, start, end, indices, exact))
+        return TermStream(lambda: (TermGroup(ops[depth + 1], children(depth + 1, {**indices, name: index}))
+                                   for index in get_range(start, end)))
+    
+    return TermGroup(ops[0], children(0, {}))
+
+def iter_term_leaves(node):
+    """Yield every leaf of a (possibly streamed) term tree in rendering order"""
+    for child in node.children:
+        if isinstance(child, TermGroup):
+            yield from iter_term_leaves(child)
+        elif child is not UNDEFINED:
+            yield child
+
+def expansion_index_space(question: dict) -> tuple:
+    """Every index tuple of a question's expansion, flattened in rendering order.
+
+    Returns (indices, row_pointers): one int64 array per index variable, and
+    for each nesting depth below the outermost the CSR row pointers grouping
+    that depth's indices by their enclosing index.
+    """
+    bounds = question_bounds(question)
+    _, start_key, end_key = bounds[0]
+    indices = [index_range(int(question[start_key]), int(question[end_key]))]
+    row_pointers = []
+    for _, start_key, end_key in bounds[1:]:
+        starts = evaluate_start_indices(question[start_key], *indices)
+        inner_indices, rows = ragged_index_range(starts, int(question[end_key]))
+        lengths = np.diff(rows)
+        indices = [np.repeat(outer, lengths) for outer in indices] + [inner_indices]
+        row_pointers.append(rows)
+    return indices, row_pointers
+
+def small_index_space(question: dict, max_cells: int = _VECTORIZE_MIN_CELLS):
+    """expansion_index_space() built from plain lists, or None once it reaches max_cells cells.
+
+    Returns (cells, row_pointers): every index tuple in rendering order and
+    the same CSR row pointers as lists. Small spaces are walked row by row
+    with get_range() and calculate_start_index(); building CSR arrays only
+    pays off for large ones.
+    """
+    bounds = question_bounds(question)
+    _, start_key, end_key = bounds[0]
+    cells = [(index,) for index in get_range(int(question[start_key]), int(question[end_key]))]
+    if len(cells) >= max_cells:
+        return None
+    row_pointers = []
+    for _, start_key, end_key in bounds[1:]:
+        start, end = question[start_key], int(question[end_key])
+        if compile_expression(str(start)).variables:
+            spans = [get_range(calculate_start_index(start, *cell), end) for cell in cells]
+        else:
+            spans = [get_range(calculate_start_index(start), end)] * len(cells)
+        rows = list(accumulate(map(len, spans), initial=0))
+        if rows[-1] >= max_cells:
+            return None
+        cells = [cell + (index,) for cell, span in zip(cells, spans) for index in span]
+        row_pointers.append(rows)
+    return cells, row_pointers
+
+def expand_small_spaces(questions: List[dict], spaces: list, known: dict, exact: bool = False) -> List[TermGroup]:
+    """Expand questions over their small_index_space(), evaluating only cells not in known.
+
+    known maps (expression, depth) to {index tuple: leaf} already evaluated
+    for that expression; the cells missing across all questions are
+    evaluated together, one call per expression, and added to it.
+    """
+    missing = {}  # (expression, depth) -> cells to evaluate, in first-seen order
+    for question, (cells, row_pointers) in zip(questions, spaces):
+        key = (question['expression'], len(row_pointers) + 1)
+        leaves = known.setdefault(key, {})
+        missing.setdefault(key, {}).update(dict.fromkeys(cell for cell in cells if cell not in leaves))
+    for (expression, depth), cells in missing.items():
+        if not cells:
+            continue
+        cells = list(cells)
+        compiled = compile_expression(expression)
+        scalar_term, format_value = expansion_term_renderers(expression, depth, exact)
+        if len(cells) < _VECTORIZE_MIN_CELLS:
+            terms = render_scalar_terms(compiled, scalar_term, cells)
+        else:
+            terms = render_grid_terms(compiled, scalar_term, format_value, *map(np.array, zip(*cells)),
+                                      scalar_floats=exact)
+        known[expression, depth].update(zip(cells, term_leaves(terms)))
+    return [assemble_term_tree(question_operators(question),
+                               [known[question['expression'], len(row_pointers) + 1][cell] for cell in cells],
+                               row_pointers)
+            for question, (cells, row_pointers) in zip(questions, spaces)]
+
+def term_tree_cells(tree: TermGroup, space: tuple) -> dict:
+    """{index tuple: leaf} of a tree expanded over the given small_index_space()"""
+    cells, row_pointers = space
+    groups = [tree]
+    for _ in row_pointers:
+        groups = [child for group in groups for child in group.children]
+    return dict(zip(cells, [leaf for group in groups for leaf in group.children]))
+
+def assemble_term_tree(ops: str, leaves: list, row_pointers: list) -> TermGroup:
+    """Nest flat leaves into groups, innermost first, following expansion_index_space()"""
+    children = leaves
+    for depth in reversed(range(len(row_pointers))):
+        children = [TermGroup(ops[depth + 1], row) for row in split_rows(children, row_pointers[depth])]
+    return TermGroup(ops[0], children)
+
+def expand_questions(questions: List[dict], exact: bool = False) -> List[TermGroup]:
+    """generate_expansion() for many questions at once.
+
+    Questions sharing an expression template (expression and depth) have
+    their index spaces concatenated and evaluated in one render_grid_terms()
+    call, then split back into one term tree each.
+    """
+    templates = {}
+    for position, question in enumerate(questions):
+        key = (question['expression'], len(question_bounds(question)))
+        templates.setdefault(key, []).append(position)
+    
+    expansions = [None] * len(questions)
+    for (expression, depth), positions in templates.items():
+        spaces = []
+        for position in positions:
+            space = small_index_space(questions[position])
+            spaces.append(expansion_index_space(questions[position]) if space is None
+                          else (list(zip(*space[0])), space[1]))
+        offsets = np.cumsum([0] + [len(indices[0]) for indices, _ in spaces]).tolist()
+        columns = [np.concatenate([indices[name] for indices, _ in spaces]) for name in range(depth)]
+        scalar_term, format_value = expansion_term_renderers(expression, depth, exact)
+        leaves = term_leaves(render_grid_terms(compile_expression(expression), scalar_term, format_value, *columns,
+                                               scalar_floats=exact))
+        for position, (_, row_pointers), start, stop in zip(positions, spaces, offsets, offsets[1:]):
+            expansions[position] = assemble_term_tree(question_operators(questions[position]),
+                                                      leaves[start:stop], row_pointers)
+    return expansions
+
+# Budgets checked before expanding; instances over any of them are resampled
+MAX_EXPANSION_TERMS = 512  # terms in one expansion
+MAX_TERM_DIGITS = 15  # integer digits of the largest possible term
+MAX_EXPANSION_BYTES = 32 * 1024  # estimated plain-text size of one expansion
+MAX_RESAMPLE_ATTEMPTS = 20  # instances drawn before giving up on the budgets
+
+# Index name and (start, end) keys of each nesting depth, by number of operations
+_QUESTION_BOUNDS = {
+    1: (('i', 'outer_start', 'outer_end'),),
+    2: (('i', 'outer_start', 'outer_end'), ('j', 'inner_start', 'inner_end')),
+    3: (('i', 'outer_start', 'outer_end'), ('j', 'middle_start', 'middle_end'), ('k', 'inner_start', 'inner_end')),
+}
+_FLOAT_TERM_WIDTH = 18  # repr() of a float term, e.g. "0.6666666666666666"
+_JOINER_WIDTH = len(' \\cdot ')
+
+def _interval_corners(a: tuple, b: tuple, op) -> tuple:
+    try:
+        corners = [op(x, y) for x in a for y in b]
+    except OverflowError:
+        return -math.inf, math.inf
+    return min(corners), max(corners)
+
+def expression_interval(node: tuple, extents: dict) -> tuple:
+    """Bound a parsed expression over index intervals without evaluating any term.
+
+    Returns (low, high, integral): an interval containing every defined value and
+    whether every value is an integer. sqrt/ln terms are shown symbolically, so
+    they are bounded by their argument, which is what gets written out.
+    """
+    kind = node[0]
+    if kind == 'num':
+        return node[1], node[1], isinstance(node[1], int)
+    if kind == 'var':
+        low, high = extents.get(node[1], (0, 0))
+        return low, high, True
+    if kind == 'neg':
+        low, high, integral = expression_interval(node[1], extents)
+        return -high, -low, integral
+    if kind == 'call':
+        return expression_interval(node[2], extents)
+
+    op = node[1]
+    a_low, a_high, a_integral = expression_interval(node[2], extents)
+    b_low, b_high, b_integral = expression_interval(node[3], extents)
+    if op == '+':
+        return a_low + b_low, a_high + b_high, a_integral and b_integral
+    if op == '-':
+        return a_low - b_high, a_high - b_low, a_integral and b_integral
+    if op == '*':
+        return (*_interval_corners((a_low, a_high), (b_low, b_high), lambda x, y: x * y), a_integral and b_integral)
+
+    a_size = max(abs(a_low), abs(a_high))
+    b_size = max(abs(b_low), abs(b_high))
+    if op == '/':
+        if b_low > 0 or b_high < 0:
+            low, high = _interval_corners((a_low, a_high), (1 / b_low, 1 / b_high), lambda x, y: x * y)
+        elif b_integral:
+            # A non-zero integer denominator is at least 1 in magnitude; zero is undefined
+            low, high = -a_size, a_size
+        else:
+            low, high = -math.inf, math.inf
+        return low, high, False
+
+    # Powers: with an integral base |a| >= 1 whenever a != 0, so negative exponents stay within 1
+    if a_integral:
+        base = max(a_size, 1)
+    elif a_low > 0 or a_high < 0:
+        base = max(a_size, 1 / min(abs(a_low), abs(a_high)))
+    else:
+        return -math.inf, math.inf, False
+    try:
+        size = float(base) ** b_size
+    except OverflowError:
+        size = math.inf
+    return -size, size, a_integral and b_integral and b_low >= 0
+
+class ExpansionCost:
+    """Size of an expansion worked out from the question's bounds alone"""
+    __slots__ = ('term_count', 'term_digits', 'estimated_bytes')
+
+    def __init__(self, term_count: int, term_digits: float, estimated_bytes: float):
+        self.term_count = term_count
+        self.term_digits = term_digits
+        self.estimated_bytes = estimated_bytes
+
+    def exceeds(self, max_terms: int = None, max_digits: int = None, max_bytes: int = None) -> bool:
+        """Whether any budget is exceeded; None falls back to the module-level limit"""
+        return (self.term_count > (MAX_EXPANSION_TERMS if max_terms is None else max_terms)
+                or self.term_digits > (MAX_TERM_DIGITS if max_digits is None else max_digits)
+                or self.estimated_bytes > (MAX_EXPANSION_BYTES if max_bytes is None else max_bytes))
+
+    def value_digits(self, products: bool) -> float:
+        """Upper bound on the integer digits of the question's numeric value"""
+        if products:
+            return self.term_count * self.term_digits
+        return self.term_digits + len(str(self.term_count))
+
+def question_bounds(question: dict) -> tuple:
+    """(index name, start key, end key) for each nesting depth of a question"""
+    return _QUESTION_BOUNDS[min(max(len(question.get('operation_sequence', '')), 1), 3)]
+
+def question_operators(question: dict) -> str:
+    """'S' or 'P' for each nesting depth; single operations follow their type"""
+    ops = question.get('operation_sequence', '')
+    if len(question_bounds(question)) == 1:
+        return 'P' if question.get('type', 'summation') == 'product' else 'S'
+    return ops
+
+def index_space_extents(question: dict) -> tuple:
+    """Exact term and group counts and the (min, max) reached by each index, without expanding.
+
+    Only the index rows above the innermost one are built, so the work grows
+    with the number of parenthesised groups rather than with the number of terms.
+    """
+    bounds = question_bounds(question)
+    space = small_index_space(question)
+    if space is not None:
+        cells, row_pointers = space
+        extents = {name: (min(column), max(column)) for (name, _, _), column in zip(bounds, zip(*cells))}
+        return len(cells), 1 + sum(len(rows) - 1 for rows in row_pointers), extents
+    env = {}
+    extents = {}
+    group_count = 1  # the outermost group; every index above the innermost opens one more
+    for depth, (name, start_key, end_key) in enumerate(bounds):
+        end = int(question[end_key])
+        if depth == 0:
+            starts = np.array([int(question[start_key])], dtype=np.int64)
+        else:
+            starts = evaluate_start_indices(question[start_key], **env)
+        lengths = np.abs(end - starts) + 1
+        extents[name] = (int(min(starts.min(), end)), int(max(starts.max(), end)))
+        if depth == len(bounds) - 1:
+            term_count = int(lengths.sum())
+            break
+        group_count += int(lengths.sum())
+        indices, rows = ragged_index_range(starts, end)
+        env = {key: np.repeat(values, np.diff(rows)) for key, values in env.items()}
+        env[name] = indices
+    return term_count, group_count, extents
+
+def estimate_expansion_cost(question: dict) -> ExpansionCost:
+    """Exact term count and a magnitude bound for a question, without expanding it"""
+    term_count, group_count, extents = index_space_extents(question)
+    compiled = compile_expression(question['expression'])
+    low, high, integral = expression_interval(compiled.ast, extents)
+    size = max(abs(low), abs(high))
+    term_digits = math.inf if math.isinf(size) else len(str(int(size)))
+    if compiled.symbolic:
+        # Terms are written out with the index values substituted in
+        index_digits = max(len(str(value)) for extent in extents.values() for value in extent)
+        term_width = len(compiled.source) + index_digits * len(re.findall(r'\b[ijk]\b', compiled.source))
     else:
-        result = ' + '.join(outer_terms) if outer_terms else "0"
+        term_width = term_digits + 1 + (0 if integral else _FLOAT_TERM_WIDTH)
+    # Every group adds its parentheses and a joiner before it in its parent
+    return ExpansionCost(term_count, term_digits,
+                         term_count * (term_width + _JOINER_WIDTH) + group_count * (2 + _JOINER_WIDTH))
+
+# Polynomials in the indices are dicts from (i, j, k) exponent tuples to Fraction coefficients
+_VARIABLE_POSITIONS = {name: position for position, name in enumerate(_INDEX_VARIABLES)}
+_CONSTANT = (0, 0, 0)
+
+def poly_constant(value) -> dict:
+    return {_CONSTANT: Fraction(value)} if value else {}
+
+def poly_variable(name: str) -> dict:
+    exponents = [0, 0, 0]
+    exponents[_VARIABLE_POSITIONS[name]] = 1
+    return {tuple(exponents): Fraction(1)}
+
+def poly_add(a: dict, b: dict, sign: int = 1) -> dict:
+    result = dict(a)
+    for exponents, coefficient in b.items():
+        value = result.get(exponents, 0) + sign * coefficient
+        if value:
+            result[exponents] = value
+        else:
+            result.pop(exponents, None)
+    return result
+
+def poly_mul(a: dict, b: dict) -> dict:
+    result = {}
+    for a_exponents, a_coefficient in a.items():
+        for b_exponents, b_coefficient in b.items():
+            exponents = tuple(x + y for x, y in zip(a_exponents, b_exponents))
+            result = poly_add(result, {exponents: a_coefficient * b_coefficient})
+    return result
+
+def poly_pow(a: dict, exponent: int) -> dict:
+    result = poly_constant(1)
+    for _ in range(exponent):
+        result = poly_mul(result, a)
+    return result
+
+def poly_degree(a: dict, name: str = None) -> int:
+    """Total degree, or the degree in one index"""
+    if not a:
+        return 0
+    if name is None:
+        return max(sum(exponents) for exponents in a)
+    return max(exponents[_VARIABLE_POSITIONS[name]] for exponents in a)
+
+def poly_constant_value(a: dict):
+    """The value of a polynomial without indices, or None if it has any"""
+    if any(exponents != _CONSTANT for exponents in a):
+        return None
+    return a.get(_CONSTANT, Fraction(0))
+
+def poly_coefficients(a: dict, name: str) -> List[dict]:
+    """Split a polynomial into coefficients (polynomials in the other indices) of name^0, name^1, ..."""
+    position = _VARIABLE_POSITIONS[name]
+    coefficients = [{} for _ in range(poly_degree(a, name) + 1)]
+    for exponents, coefficient in a.items():
+        rest = exponents[:position] + (0,) + exponents[position + 1:]
+        coefficients[exponents[position]][rest] = coefficient
+    return coefficients
+
+def poly_evaluate(coefficients: List[dict], value: dict) -> dict:
+    """Evaluate sum_p coefficients[p] * x^p at a polynomial x with Horner's rule"""
+    result = {}
+    for coefficient in reversed(coefficients):
+        result = poly_add(poly_mul(result, value), coefficient)
+    return result
+
+def poly_substitute(a: dict, name: str, value: dict) -> dict:
+    """Replace one index of a polynomial by another polynomial"""
+    return poly_evaluate(poly_coefficients(a, name), value)
+
+def poly_bind(a: dict, bindings: dict, keep: str = None) -> dict:
+    """Substitute bound index values; unbound indices other than keep are 0, as in evaluation"""
+    for name in _INDEX_VARIABLES:
+        if name != keep:
+            a = poly_substitute(a, name, poly_constant(bindings.get(name, 0)))
+    return a
+
+def expression_polynomial(node: tuple):
+    """A parsed expression as a polynomial in the indices, or None if it is not one"""
+    kind = node[0]
+    if kind == 'num':
+        return poly_constant(node[1]) if isinstance(node[1], int) else poly_constant(Fraction(str(node[1])))
+    if kind == 'var':
+        return poly_variable(node[1])
+    if kind == 'call':
+        return None
+    if kind == 'neg':
+        operand = expression_polynomial(node[1])
+        return None if operand is None else poly_add({}, operand, -1)
+    op = node[1]
+    a = expression_polynomial(node[2])
+    b = expression_polynomial(node[3])
+    if a is None or b is None:
+        return None
+    if op in ('+', '-'):
+        return poly_add(a, b, 1 if op == '+' else -1)
+    if op == '*':
+        return poly_mul(a, b)
+    divisor = poly_constant_value(b)
+    if op == '/':
+        if not divisor:
+            return None
+        return {exponents: coefficient / divisor for exponents, coefficient in a.items()}
+    if divisor is None or divisor.denominator != 1 or divisor < 0:
+        return None
+    return poly_pow(a, int(divisor))
+
+@lru_cache(maxsize=64)
+def faulhaber_coefficients(power: int) -> Tuple[Fraction, ...]:
+    """Coefficients of S_p(n) = 1^p + 2^p + ... + n^p as a polynomial in n.
+
+    Uses (n+1)^(p+1) - 1 = sum over m <= p of C(p+1, m) * S_m(n). The identity
+    S_p(n) - S_p(n-1) = n^p holds for every integer n, so sums over any
+    ascending range [a, b] are S_p(b) - S_p(a - 1), negative indices included.
+    """
+    coefficients = [Fraction(math.comb(power + 1, m)) for m in range(power + 2)]
+    coefficients[0] -= 1
+    for m in range(power):
+        for degree, value in enumerate(faulhaber_coefficients(m)):
+            coefficients[degree] -= math.comb(power + 1, m) * value
+    return tuple(value / (power + 1) for value in coefficients)
+
+def _range_sum(coefficients: List[dict], low: dict, high: dict) -> dict:
+    """sum over v in [low, high] of sum_p coefficients[p] * v^p, as a polynomial"""
+    result = {}
+    below_low = poly_add(low, poly_constant(1), -1)
+    for power, coefficient in enumerate(coefficients):
+        if coefficient:
+            faulhaber = [poly_constant(value) for value in faulhaber_coefficients(power)]
+            span = poly_add(poly_evaluate(faulhaber, high), poly_evaluate(faulhaber, below_low), -1)
+            result = poly_add(result, poly_mul(coefficient, span))
+    return result
+
+def _linear_start(question: dict, start_key: str, extents: dict, end: int):
+    """A start bound as a linear polynomial with integer coefficients, with its
+    (min, max) over the box spanned by the outer index extents, or None if the
+    bound is not linear in the outer indices."""
+    start = expression_polynomial(compile_expression(str(question[start_key])).ast)
+    if start is None or poly_degree(start) > 1 or any(value.denominator != 1 for value in start.values()):
+        return None
+    if any(power and name not in extents
+           for exponents in start for name, power in zip(_INDEX_VARIABLES, exponents)):
+        return None
+    # A linear bound is extreme at the corners of the box
+    corners = [{}]
+    for name, (low, high) in extents.items():
+        corners = [{**corner, name: value} for corner in corners for value in (low, high)]
+    values = [sum(coefficient * math.prod(corner.get(name, 0) ** power
+                                          for name, power in zip(_INDEX_VARIABLES, exponents))
+                  for exponents, coefficient in start.items())
+              for corner in corners]
+    return start, min(values), max(values)
+
+def closed_form_sum(question: dict):
+    """Exact value of an all-summation question with a polynomial summand, or None.
+
+    Sums are taken from the innermost index outwards with Faulhaber polynomials,
+    so correlated linear bounds stay symbolic and the cost does not depend on n.
+    A start bound must stay on one side of its end bound for every outer row.
+    """
+    ops = question_operators(question)
+    if set(ops) != {'S'}:
+        return None
+    summand = expression_polynomial(compile_expression(question['expression']).ast)
+    if summand is None:
+        return closed_form_geometric_sum(question)
+    bounds = question_bounds(question)
+    for name in _INDEX_VARIABLES[len(bounds):]:
+        summand = poly_substitute(summand, name, {})
+    
+    # Outer to inner: each index's bounds and the box its values lie in
+    extents = {}
+    ranges = []
+    for name, start_key, end_key in bounds:
+        end = int(question[end_key])
+        start = _linear_start(question, start_key, extents, end)
+        if start is None:
+            return None
+        start, low, high = start
+        if high <= end:
+            ranges.append((start, poly_constant(end)))
+        elif low >= end:
+            ranges.append((poly_constant(end), start))
+        else:
+            return None
+        extents[name] = (min(low, end), max(high, end))
     
-    # Add parentheses if multiple outer terms
-    if len(outer_terms) > 1:
-        result = f"({result})"
+    for (name, _, _), (low, high) in reversed(list(zip(bounds, ranges))):
+        summand = _range_sum(poly_coefficients(summand, name), low, high)
+    return poly_constant_value(summand)
+
+def _geometric_series(ratio: Fraction, low: int, high: int) -> Fraction:
+    """ratio^low + ratio^(low + 1) + ... + ratio^high"""
+    if ratio == 1:
+        return Fraction(high - low + 1)
+    return (ratio ** (high + 1) - ratio ** low) / (ratio - 1)
+
+def _exponential_parts(node: tuple):
+    """(r, g) for an expression r^g with a constant r != 0 and polynomial g, else None"""
+    if node[0] != 'bin' or node[1] != '^':
+        return None
+    base = expression_polynomial(node[2])
+    exponent = expression_polynomial(node[3])
+    base = None if base is None else poly_constant_value(base)
+    if not base or exponent is None:
+        return None
+    return base, exponent
+
+def closed_form_geometric_sum(question: dict):
+    """Exact value of an all-summation r^(linear) question over constant bounds, or None.
+
+    r^(c + a*i + b*j) over a rectangle factors into r^c times one geometric
+    series per index.
+    """
+    parts = _exponential_parts(compile_expression(question['expression']).ast)
+    if parts is None:
+        return None
+    base, exponent = parts
+    bounds = question_bounds(question)
+    names = [name for name, _, _ in bounds]
+    for name in _INDEX_VARIABLES:
+        if name not in names:
+            exponent = poly_substitute(exponent, name, {})
+    if poly_degree(exponent) > 1 or any(value.denominator != 1 for value in exponent.values()):
+        return None
+    value = base ** int(exponent.get(_CONSTANT, 0))
+    for name, start_key, end_key in bounds:
+        start = expression_polynomial(compile_expression(str(question[start_key])).ast)
+        start = None if start is None else poly_constant_value(start)
+        if start is None or start.denominator != 1:
+            return None
+        slope = poly_coefficients(exponent, name)
+        slope = int(poly_constant_value(slope[1])) if len(slope) > 1 else 0
+        end = int(question[end_key])
+        value *= _geometric_series(base ** slope, min(int(start), end), max(int(start), end))
+    return value
+
+def exact_value(node: tuple, env: dict) -> Fraction:
+    """Evaluate a parsed expression exactly; raises ValueError for sqrt/ln and
+    ZeroDivisionError for undefined terms"""
+    kind = node[0]
+    if kind == 'num':
+        return Fraction(str(node[1])) if isinstance(node[1], float) else Fraction(node[1])
+    if kind == 'var':
+        return Fraction(env.get(node[1], 0))
+    if kind == 'call':
+        raise ValueError(f"{node[1]} has no exact rational value")
+    if kind == 'neg':
+        return -exact_value(node[1], env)
+    op = node[1]
+    a = exact_value(node[2], env)
+    b = exact_value(node[3], env)
+    if op == '+':
+        return a + b
+    if op == '-':
+        return a - b
+    if op == '*':
+        return a * b
+    if op == '/':
+        return a / b
+    if b.denominator != 1:
+        raise ValueError("Fractional exponents have no exact rational value")
+    return a ** int(b)
+
+@lru_cache(maxsize=65536)
+def exact_term(expression: str, i: int = 0, j: int = 0, k: int = 0) -> Fraction:
+    """Memoized exact value of one term, shared by expansions, distractors and numeric answers"""
+    return exact_value(compile_expression(expression).ast, {'i': i, 'j': j, 'k': k})
+
+def _rising_product(low: int, high: int) -> int:
+    """low * (low + 1) * ... * high through factorials"""
+    if low <= 0 <= high:
+        return 0
+    if low > 0:
+        return math.factorial(high) // math.factorial(low - 1)
+    return (-1) ** (high - low + 1) * (math.factorial(-low) // math.factorial(-high - 1))
+
+def _row_value(op: str, compiled: CompiledExpression, name: str, start: int, end: int, bindings: dict) -> Fraction:
+    """Sum or product of the expression over one row of the innermost index.
+
+    Closed forms: Faulhaber for polynomial sums, factorials for products of
+    c * (v + q)^p, and geometric series or exponent sums for r^(g(v)). Anything
+    else is reduced exactly over the vectorized grid.
+    """
+    node = compiled.ast
+    low, high = min(start, end), max(start, end)
+    count = high - low + 1
+    poly = expression_polynomial(node)
+    if poly is not None:
+        poly = poly_bind(poly, bindings, name)
+        if op == 'S':
+            return poly_constant_value(_range_sum(poly_coefficients(poly, name),
+                                                  poly_constant(low), poly_constant(high)))
+        coefficients = [poly_constant_value(coefficient) for coefficient in poly_coefficients(poly, name)]
+        degree = len(coefficients) - 1
+        lead = coefficients[-1]
+        shift = coefficients[-2] / (degree * lead) if degree else Fraction(0)
+        if shift.denominator == 1 and all(
+                coefficients[power] == lead * math.comb(degree, power) * shift ** (degree - power)
+                for power in range(degree + 1)):
+            # c * (v + q)^p: a shifted factorial ratio raised to p
+            shift = int(shift)
+            return lead ** count * Fraction(_rising_product(low + shift, high + shift)) ** degree
+    elif _exponential_parts(node) is not None:
+        base, exponent = _exponential_parts(node)
+        exponent = poly_bind(exponent, bindings, name)
+        coefficients = [poly_constant_value(c) for c in poly_coefficients(exponent, name)]
+        if op == 'P':
+            # r^g(low) * ... * r^g(high) = r^(sum of g)
+            total = poly_constant_value(_range_sum(poly_coefficients(exponent, name),
+                                                   poly_constant(low), poly_constant(high)))
+            if total.denominator == 1:
+                return base ** int(total)
+        elif len(coefficients) <= 2 and all(c.denominator == 1 for c in coefficients):
+            offset, slope = (coefficients + [Fraction(0)])[:2]
+            return base ** int(offset) * _geometric_series(base ** int(slope), low, high)
+    return _reduce_row(op, compiled, name, low, high, bindings)
+
+def _reduce_row(op: str, compiled: CompiledExpression, name: str, low: int, high: int, bindings: dict) -> Fraction:
+    """Exact sum or product of one row, evaluated chunk by chunk on the vectorized grid"""
+    total = Fraction(0) if op == 'S' else Fraction(1)
+    if high - low + 1 < _VECTORIZE_MIN_CELLS:
+        terms = [exact_term(compiled.source, **bindings, **{name: index}) for index in range(low, high + 1)]
+        return total + sum(terms) if op == 'S' else math.prod(terms)
+    for chunk in iter_index_chunks(low, high):
+        grid = {**bindings, name: chunk}
+        values, is_float, masked = evaluate_grid(compiled, **grid)
+        exact = ~(np.asarray(is_float, dtype=bool) | np.asarray(masked, dtype=bool))
+        ints = values[exact].astype(np.int64).tolist()
+        rest = [exact_term(compiled.source, **bindings, **{name: index}) for index in chunk[~exact].tolist()]
+        if op == 'S':
+            total += sum(ints) + sum(rest, Fraction(0))
+        else:
+            total *= math.prod(ints) * math.prod(rest)
+            if not total:
+                break
+    return total
+
+def evaluate_question_value(question: dict) -> Fraction:
+    """Exact numeric value of a sum/product question without building its expansion.
+
+    All-summation questions with polynomial summands are solved symbolically;
+    otherwise the outer indices are iterated and each innermost row uses
+    _row_value(). Raises ValueError for sqrt/ln and ZeroDivisionError when a
+    term is undefined.
+    """
+    value = closed_form_sum(question)
+    if value is not None:
+        return value
     
-    return result
+    ops = question_operators(question)
+    bounds = question_bounds(question)
+    compiled = compile_expression(question['expression'])
+    
+    def level_value(depth: int, bindings: dict) -> Fraction:
+        name, start_key, end_key = bounds[depth]
+        start = calculate_start_index(question[start_key], **bindings)
+        end = int(question[end_key])
+        if depth == len(bounds) - 1:
+            return _row_value(ops[depth], compiled, name, start, end, bindings)
+        values = (level_value(depth + 1, {**bindings, name: index}) for index in get_range(start, end))
+        if ops[depth] == 'P':
+            return math.prod(values, start=Fraction(1))
+        return sum(values, Fraction(0))
+    
+    return level_value(0, {})
+
+def format_exact_value(value: Fraction) -> str:
+    """Plain-text numeric answer, e.g. "42" or "-7/2" """
+    return str(value.numerator) if value.denominator == 1 else f"{value.numerator}/{value.denominator}"
+
+def exact_value_katex(value: Fraction) -> str:
+    """KaTeX numeric answer with \\frac for non-integers"""
+    if value.denominator == 1:
+        return str(value.numerator)
+    sign = '-' if value < 0 else ''
+    return f"{sign}\\frac{{{abs(value.numerator)}}}{{{value.denominator}}}"
+
+def numeric_distractors(question: dict, value: Fraction) -> List[Fraction]:
+    """Three wrong values from common slips: dropping the last outer index,
+    starting the innermost index one later, and a sign error"""
+    bounds = question_bounds(question)
+    _, outer_start_key, outer_end_key = bounds[0]
+    _, inner_start_key, _ = bounds[-1]
+    outer_start, outer_end = int(question[outer_start_key]), int(question[outer_end_key])
+    
+    exclusive_end = dict(question)
+    exclusive_end[outer_end_key] = str(outer_end - 1 if outer_start <= outer_end else outer_end + 1)
+    late_start = dict(question)
+    late_start[inner_start_key] = f"({question[inner_start_key]})+1"
+    
+    distractors = []
+    candidates = [exclusive_end, late_start]
+    for candidate in candidates:
+        try:
+            distractors.append(evaluate_question_value(candidate))
+        except (ArithmeticError, ValueError):
+            pass
+    distractors.append(-value)
+    
+    # Keep distinct wrong values and pad with nearby ones
+    unique = []
+    for distractor in distractors:
+        if distractor != value and distractor not in unique:
+            unique.append(distractor)
+    padding = 1
+    while len(unique) < 3:
+        if value + padding not in unique:
+            unique.append(value + padding)
+        padding += 1
+    return unique[:3]
 
 def combine_terms(terms: List[str], operation: str) -> str:
     """Combine terms based on operation type"""
@@ -883,105 +1936,158 @@ def combine_terms(terms: List[str], operation: str) -> str:
 def calculate_start_index(expr: str, i: int = None, j: int = None) -> int:
     """Calculate start index for correlated indices."""
     try:
-        # Replace variables with their values
-        if 'i' in expr and i is not None:
-            expr = expr.replace('i', str(i))
-        if 'j' in expr and j is not None:
-            expr = expr.replace('j', str(j))
-        return eval(expr)
-    except:
+        return int(compile_expression(str(expr))(0 if i is None else i, 0 if j is None else j))
+    except (ArithmeticError, ValueError):
         return 1  # Default to 1 if evaluation fails
 
-def generate_distractors(correct_expansion: str, question: dict) -> List[str]:
-    """Generate plausible but incorrect expansions"""
-    operation_type = question.get('type', 'summation')
-    operator = ' \\cdot ' if 'product' in operation_type else ' + '
-    
-    def format_term(term: str) -> str:
-        """Format a term with proper fraction notation"""
-        if '/' in term:
-            parts = term.split('/')
-            if len(parts) == 2:
-                num, den = parts
-                # Handle terms with parentheses
-                num = num.strip('()')
-                den = den.strip('()')
-                return f"\\frac{{{num}}}{{{den.strip('()')}}}"
-        return term
-    
-    def modify_terms(terms: List[str], attempt: int) -> str:
-        """Create a plausible wrong expansion by modifying terms"""
-        modified = terms.copy()
-        
-        # Choose modification based on attempt number to ensure variety
-        modifications = ['skip_term', 'repeat_term', 'change_sign', 'off_by_one']
-        modification = modifications[attempt % len(modifications)]
-        
-        if modification == 'skip_term':
-            if len(modified) > 2:
-                modified.pop(random.randint(1, len(modified)-2))
-        elif modification == 'repeat_term':
-            if modified:
-                term_to_repeat = random.choice(modified)
-                insert_pos = random.randint(0, len(modified))
-                modified.insert(insert_pos, term_to_repeat)
-        elif modification == 'change_sign':
-            if modified:
-                idx = random.randint(0, len(modified)-1)
-                try:
-                    val = int(modified[idx])
-                    modified[idx] = str(-val)
-                except:
-                    pass
-        elif modification == 'off_by_one':
-            if modified:
-                idx = random.randint(0, len(modified)-1)
-                try:
-                    val = int(modified[idx])
-                    modified[idx] = str(val + random.choice([-1, 1]))
-                except:
-                    pass
-        
-        # Format any terms containing division
-        modified = [format_term(term) for term in modified]
-        return operator.join(modified)
-    
-    # Split correct expansion into terms
-    terms = correct_expansion.split(operator)
-    
-    # Generate two different distractors with maximum attempts
-    max_attempts = 10
-    distractors = []
-    attempt = 0
-    
-    while len(distractors) < 2 and attempt < max_attempts:
-        distractor = modify_terms(terms, attempt)
-        if (distractor != correct_expansion and 
-            distractor not in distractors):
-            distractors.append(distractor)
-        attempt += 1
-    
-    # If we couldn't generate two unique distractors, fill with default ones
-    while len(distractors) < 2:
-        default_distractor = correct_expansion + " + 1"
-        if default_distractor not in distractors:
-            distractors.append(default_distractor)
-    
-    # Generate third distractor by swapping '+' and '\\cdot'
-    temp_distractor = correct_expansion.replace(' + ', 'TEMP').replace(' \\cdot ', ' + ').replace('TEMP', ' \\cdot ')
-    if (temp_distractor != correct_expansion and 
-        temp_distractor not in distractors):
-        distractors.append(temp_distractor)
-    
-    # Ensure we have 3 distractors, fill with default if needed
-    while len(distractors) < 3:
-        default_distractor = correct_expansion + " + 1"
-        if default_distractor not in distractors:
-            distractors.append(default_distractor)
+_CORRELATED_START = re.compile(r'\s*([ijk])\s*[-+]\s*\d+\s*')  # e.g. "i+1", "j-2"
 
-    # print("Distractors: ", distractors)
-    
-    return distractors
+def _end_step(question: dict, start_key: str, end_key: str) -> int:
+    """+1 if the range of end_key counts upwards, else -1; correlated starts count upwards"""
+    try:
+        return 1 if int(question[start_key]) <= int(question[end_key]) else -1
+    except ValueError:
+        return 1
+
+def negate_exponent(expression: str):
+    """The expression with the sign of its first exponent flipped, e.g. "i^2 + j" -> "i^(-2) + j";
+    None when it has no exponent"""
+    spans = []
+    pos, text = 0, expression.rstrip()
+    while pos < len(text):
+        match = _EXPR_TOKEN.match(text, pos)
+        if not match:
+            return None
+        spans.append((match.group(match.lastindex), match.start(match.lastindex), match.end()))
+        pos = match.end()
+    tokens = [token for token, _, _ in spans]
+    if '^' not in tokens:
+        return None
+    first = tokens.index('^') + 1
+    # The exponent is a unary operand: optional '-', then an atom, call or bracketed group
+    last = first + (first < len(tokens) and tokens[first] == '-')
+    if last < len(tokens) and tokens[last] in _EXPR_FUNCTIONS:
+        last += 1
+    depth = 0
+    while last < len(tokens):
+        depth += {'(': 1, ')': -1}.get(tokens[last], 0)
+        if depth <= 0:
+            break
+        last += 1
+    if last >= len(tokens):
+        return None
+    begin, finish = spans[first][1], spans[last][2]
+    operand = text[begin:finish]
+    flipped = operand[1:].lstrip() if tokens[first] == '-' else f"(-{operand})"
+    return text[:begin] + flipped + text[finish:]
+
+def question_mistakes(question: dict) -> List[dict]:
+    """Copies of the question with one common mistake each, most specific first.
+
+    Correlation offset dropped, exponent sign flipped, inner and outer
+    operators swapped, outer index started at 0, and the end treated as
+    exclusive (outer index) or one past inclusive (innermost index); then the
+    same slips on the inner indices. Mistakes that would leave the question
+    unchanged are left out.
+    """
+    bounds = question_bounds(question)
+    mistakes = []
+    
+    def mistake(**changes) -> None:
+        if any(question.get(key) != value for key, value in changes.items()):
+            mistakes.append({**question, **changes})
+    
+    mistake(**{start_key: match.group(1) for _, start_key, _ in bounds[1:]
+               for match in [_CORRELATED_START.fullmatch(str(question[start_key]))] if match})
+    expression = negate_exponent(question['expression'])
+    if expression:
+        mistake(expression=expression)
+    
+    ops = question_operators(question)
+    if len(bounds) == 1:
+        mistake(type='summation' if ops == 'P' else 'product')
+    else:
+        # Reversing a palindrome like "SPS" changes nothing, so those flip every operator
+        swapped = ops[::-1] if ops[::-1] != ops else ops.translate(str.maketrans('SP', 'PS'))
+        mistake(operation_sequence=swapped)
+    
+    _, outer_start_key, outer_end_key = bounds[0]
+    _, inner_start_key, inner_end_key = bounds[-1]
+    mistake(**{outer_start_key: "0"})
+    outer_start, outer_end = int(question[outer_start_key]), int(question[outer_end_key])
+    if outer_start != outer_end:
+        # A one-index range has no exclusive end: stepping back would reverse it and add a term
+        mistake(**{outer_end_key: str(outer_end - _end_step(question, outer_start_key, outer_end_key))})
+    inner_end = int(question[inner_end_key])
+    mistake(**{inner_end_key: str(inner_end + _end_step(question, inner_start_key, inner_end_key))})
+    
+    for _, start_key, _ in bounds[1:]:
+        mistake(**{start_key: "0"})
+    for _, start_key, end_key in bounds[1:-1]:
+        mistake(**{end_key: str(int(question[end_key]) + _end_step(question, start_key, end_key))})
+    return mistakes
+
+# Distractors reuse the answer's terms by index tuple up to this many cells; a
+# lookup is cheaper than evaluating at any size, the bound only limits the lists built
+_REUSE_MAX_CELLS = 4096
+
+def generate_distractors(correct_expansion: TermGroup, question: dict, fold: int = None,
+                         exact: bool = False, render_katex=term_tree_to_katex) -> List[TermGroup]:
+    """Up to three wrong expansions of one question; see batch_distractors()"""
+    return batch_distractors([correct_expansion], [question], fold, exact, render_katex)[0]
+
+def batch_distractors(correct_expansions: List[TermGroup], questions: List[dict], fold: int = None,
+                      exact: bool = False, render_katex=term_tree_to_katex) -> List[List[TermGroup]]:
+    """Up to three wrong expansions per question, each the expansion of question_mistakes().
+
+    Mistakes are expanded only as many at a time as distractors are still
+    missing, and kept when their KaTeX differs from the answer's and each
+    other's, so terms that only differ before rounding count as equal; there
+    are no retries and no padding. Pass a memoized render_katex to reuse the
+    renderings for output. Fewer than three come back only when the mistakes
+    coincide; callers then redraw the instance.
+
+    Each round expands the pending mistakes of every question together. Small
+    ones reuse the evaluated terms of any answer or mistake with the same
+    expression by index tuple, so a swapped operator or a shifted bound only
+    evaluates the cells none of them has, and the cells still missing are
+    evaluated one call per expression across the batch. Larger ones go through
+    expand_questions(). With fold, correct_expansions are already folded and
+    mistakes are streamed and folded the same way.
+    """
+    pending = [question_mistakes(question) for question in questions]
+    seen = [{render_katex(correct)} for correct in correct_expansions]
+    distractors = [[] for _ in questions]
+    known = {}  # (expression, depth) -> {index tuple: leaf}
+    if not fold:
+        for correct, question in zip(correct_expansions, questions):
+            space = small_index_space(question, _REUSE_MAX_CELLS)
+            if space is not None:
+                known.setdefault((question['expression'], len(space[1]) + 1), {}).update(
+                    term_tree_cells(correct, space))
+    while True:
+        positions, batch = [], []
+        for position, mistakes in enumerate(pending):
+            wanted = 3 - len(distractors[position])
+            if wanted > 0 and mistakes:
+                positions.extend([position] * len(mistakes[:wanted]))
+                batch.extend(mistakes[:wanted])
+                pending[position] = mistakes[wanted:]
+        if not batch:
+            return distractors
+        if fold:
+            candidates = [fold_term_tree(stream_expansion(mistake, exact), fold) for mistake in batch]
+        else:
+            spaces = [small_index_space(mistake, _REUSE_MAX_CELLS) for mistake in batch]
+            small = iter(expand_small_spaces([mistake for mistake, space in zip(batch, spaces) if space is not None],
+                                             [space for space in spaces if space is not None], known, exact))
+            large = iter(expand_questions([mistake for mistake, space in zip(batch, spaces) if space is None], exact))
+            candidates = [next(large) if space is None else next(small) for space in spaces]
+        for position, candidate in zip(positions, candidates):
+            katex = render_katex(candidate)
+            if katex not in seen[position]:
+                seen[position].add(katex)
+                distractors[position].append(candidate)
 
 # Helper function for generate_distractors
 def format_expression(expression: str) -> str:
@@ -1059,118 +2165,6 @@ def format_decimal(value: str) -> str:
     except ValueError:
         return value
 
-def convert_to_katex(expansion: str) -> str:
-    """Convert expansion to proper KaTeX notation with decimal formatting"""
-    if not expansion or '=' not in expansion:
-        # Format decimal numbers in the expansion
-        terms = expansion.split(' ')
-        formatted_terms = []
-        for term in terms:
-            if '\\cdot' in term or '+' in term or term.strip() in ['\\cdot', '+']:
-                formatted_terms.append(term)
-            else:
-                formatted_terms.append(format_decimal(term))
-        expansion = ' '.join(formatted_terms)
-        
-        # Format power expressions in the expansion
-        if '^' in expansion:
-            # Handle expressions with parentheses first
-            expansion = re.sub(r'\((.*?)\)\^(-?\d+)(?!})', r'(\1)^{\2}', expansion)
-            # Handle simple expressions without parentheses
-            expansion = re.sub(r'([^\^]*?)\^(-?\d+)(?!})', r'\1^{\2}', expansion)
-        return expansion.replace('*', '\\cdot')
-
-    # Split the expression and result
-    parts = expansion.split('=')
-    expression = parts[0].strip()
-    
-    # Replace all multiplication symbols with \cdot
-    expression = expression.replace('×', '\\cdot').replace('*', '\\cdot')
-    
-    # Convert division expressions to fractions
-    def convert_division(match):
-        numerator, denominator = match.group(1), match.group(2)
-        # Handle arithmetic in numerator and denominator
-        if '--' in numerator:
-            numerator = numerator.replace('--', '+')
-        if '--' in denominator:
-            denominator = denominator.replace('--', '+')
-        # Remove any stray parentheses around single numbers in denominator
-        if denominator.startswith('(') and denominator.endswith(')'):
-            denominator = denominator.strip('()')  # Simply strip parentheses
-            try:
-                # Check if it's a number and not zero
-                if float(denominator) == 0:
-                    denominator = '0'
-                else:
-                    denominator = str(float(denominator))
-            except ValueError:
-                # If not a simple number, put parentheses back
-                denominator = f"({denominator})"
-        return f"\\frac{{{numerator}}}{{{denominator.strip('()')}}}"
-    
-    # Handle division with parentheses first
-    expression = re.sub(r'\(([^/]+)\)/\(([^)]+)\)', convert_division, expression)
-    # Handle simple divisions
-    expression = re.sub(r'([^/]+)/([^+\s\\\cdot]+)', convert_division, expression)
-    
-    # Pre-process power expressions with arithmetic
-    def process_power_expr(match):
-        expr = match.group(1)
-        power = match.group(2)
-        # Handle arithmetic in the base
-        if '--' in expr:
-            expr = expr.replace('--', '+')
-        # Format the power - always wrap in curly braces for consistency
-        power = '{' + power + '}'
-        return f"({expr})^{power}"
-    
-    # Handle power expressions with arithmetic in base
-    expression = re.sub(r'\(([-\d]+--[-\d]+)\)\^(-?\d+)', process_power_expr, expression)
-    
-    # Format the expression
-    terms = expression.split('\\cdot')
-    formatted_terms = []
-    for term in terms:
-        term = term.strip()
-        
-        # Handle expressions with powers
-        if '^' in term:
-            if term.startswith('(') and term.endswith(')') and '^{' in term:
-                # Already properly formatted with curly braces
-                formatted_terms.append(term)
-                continue
-                
-            base, exponent = term.split('^', 1)
-            # Clean up the base
-            base = base.strip()
-            if '(' in base or '+' in base or '-' in base:
-                base = f"({base})"
-            
-            # Clean up the exponent and ensure it's wrapped in curly braces
-            exponent = exponent.strip()
-            if not (exponent.startswith('{') and exponent.endswith('}')):
-                exponent = '{' + exponent + '}'
-            
-            formatted_term = f"{base}^{exponent}"
-        else:
-            formatted_term = term
-            
-        formatted_terms.append(formatted_term)
-    
-    # Join terms with proper multiplication symbol
-    expression = ' \\cdot '.join(formatted_terms)
-    
-    # Final cleanup for any remaining arithmetic in powers
-    expression = re.sub(r'\((\d+)--(\d+)\)', r'(\1+\2)', expression)
-    
-    # Ensure all remaining exponents are wrapped in curly braces
-    expression = re.sub(r'\^(-?\d+)(?!})', r'^{\1}', expression)
-    # Handle any remaining power expressions with parentheses
-    expression = re.sub(r'\((.*?)\)\^(-?\d+)(?!})', r'(\1)^{\2}', expression)
-    
-    return expression
-
 def generate_katex_html(math_expression: str) -> str:
     """Generate HTML with KaTeX rendering for a single expression"""
     return f"""
@@ -1212,94 +2206,380 @@ def standardize_question_format(question: dict) -> dict:
     
     return std_question
 
-def generate_mixed_double_question_by_level(operation_sequence: str, level: int) -> dict:
+def generate_mixed_double_question_by_level(operation_sequence: str, level: int, rng=random) -> dict:
     """Generate double operation questions with mixed summation and product."""
-    outer_op = "summation" if operation_sequence[0] == "S" else "product"
-    inner_op = "summation" if operation_sequence[1] == "S" else "product"
-    
-    # Generate outer question
-    outer_question = generate_question_by_level(level, outer_op)
-    
-    # Generate inner question
-    inner_question = generate_question_by_level(level, inner_op)
-    
-    # Combine into a double operation question with both i and j
-    expression = random.choice([
-        "i+j",
-        "i*j",
-        "i^j",
-        f"{random.randint(2,4)}*i*j",
-        f"i^2 + j^2",
-        "(i+j)^2",
-         f"ln(i+j)"
-    ])
+    return question_generator(rng).mixed_double(operation_sequence, level)
 
-    return {
-        "outer_start": outer_question["outer_start"],
-        "outer_end": outer_question["outer_end"],
-        "inner_start": inner_question["outer_start"],
-        "inner_end": inner_question["outer_end"],
-        "expression": expression,  # Use the new expression with both i and j
-        "type": operation_sequence,
-        "level": level,
-        "operation_sequence": operation_sequence
-    }
+class SumProductGenerator:
+    """Generator singletons sharing one RNG, and the (ProblemType, level) table routing to them.
+
+    Each table entry is a zero-argument callable, built once, so drawing a
+    question costs one dictionary lookup. New problem types are added to
+    _PROBLEM_ROUTES (or via register()) rather than to a branch chain.
+    """
+    __slots__ = ('rng', 'expressions', 'doubles', 'triples', 'table')
+
+    def __init__(self, rng=random):
+        self.rng = rng
+        self.expressions = ExpressionGenerator(rng)
+        self.doubles = DoubleOperationGenerator(rng)
+        self.triples = TripleOperationGenerator(rng)
+        self.table = {}
+        for problem, route in _PROBLEM_ROUTES.items():
+            self.register(problem, route(self, PROBLEM_SEQUENCES[problem]))
+
+    def register(self, problem: ProblemType, levels: Dict[int, Callable[[], dict]]):
+        """Route each level of problem to a zero-argument question callable"""
+        for level, draw in levels.items():
+            self.table[problem, level] = draw
+
+    def generate(self, problem: ProblemType, level: int) -> dict:
+        """Draw one question of the given problem type and level"""
+        try:
+            draw = self.table[problem, level]
+        except KeyError:
+            levels = sorted(known for routed, known in self.table if routed == problem)
+            raise ValueError(f"Invalid level: {level}. Supported levels are {levels[0]}-{levels[-1]}") from None
+        return draw()
 
-def aqg_sums_and_products(prob_number: int, level_number: int) -> dict:
-    """Main interface function for auto question generation."""
+    def single(self, level: int, operation_type: str = "summation") -> dict:
+        """Single operation question for the specified level"""
+        rng = self.rng
+        if level == 1:
+            # Level 1: Small positive integers
+            n = rng.randint(3, 5)
+            return {
+                "outer_start": "1",
+                "outer_end": str(n),
+                "expression": "i",
+                "type": operation_type,
+                "operation_sequence": "S" if operation_type == "summation" else "P"
+            }
+        elif level == 2:
+            # Level 2: Mix of positive and negative integers
+            start = rng.randint(-5, -1)
+            end = rng.randint(1, 5)
+            return {
+                "outer_start": str(start),
+                "outer_end": str(end),
+                "expression": "i^2",
+                "type": operation_type,
+                "operation_sequence": "S" if operation_type == "summation" else "P"
+            }
+        else:  # level 3 or 4
+            # Level 3/4: Larger range of integers with complex expressions
+            if operation_type == "product":
+                # Keep range smaller for products to avoid huge numbers
+                start = rng.randint(-4, -1)
+                end = rng.randint(2, 4)
+            else:
+                # Larger range for summations
+                start = rng.randint(-8, -3)
+                end = rng.randint(3, 8)
+
+            return {
+                "outer_start": str(start),
+                "outer_end": str(end),
+                "expression": self.expressions.generate_complex_expression(operation_type),
+                "type": operation_type,
+                "operation_sequence": "S" if operation_type == "summation" else "P"
+            }
+
+    def double_level1(self, operation_type: str = "summation") -> dict:
+        """Level 1 double operation question with both ends redrawn as integers"""
+        question = self.doubles.generate_level1(operation_type)
+        question['outer_end'] = self.rng.randint(3, 5)  # Replace 'n' with concrete value
+        question['inner_end'] = self.rng.randint(4, 6)  # Replace 'm' with concrete value
+        return question
+
+    def mixed_double(self, operation_sequence: str, level: int) -> dict:
+        """Double operation question with mixed summation and product"""
+        outer_op = "summation" if operation_sequence[0] == "S" else "product"
+        inner_op = "summation" if operation_sequence[1] == "S" else "product"
+
+        # Generate outer question
+        outer_question = self.single(level, outer_op)
+
+        # Generate inner question
+        inner_question = self.single(level, inner_op)
+
+        # Combine into a double operation question with both i and j
+        expression = self.rng.choice([
+            "i+j",
+            "i*j",
+            "i^j",
+            f"{self.rng.randint(2,4)}*i*j",
+            f"i^2 + j^2",
+            "(i+j)^2",
+             f"ln(i+j)"
+        ])
+
+        return {
+            "outer_start": outer_question["outer_start"],
+            "outer_end": outer_question["outer_end"],
+            "inner_start": inner_question["outer_start"],
+            "inner_end": inner_question["outer_end"],
+            "expression": expression,  # Use the new expression with both i and j
+            "type": operation_sequence,
+            "level": level,
+            "operation_sequence": operation_sequence
+        }
+
+    def single_routes(self, operation_sequence: str) -> Dict[int, Callable[[], dict]]:
+        """Levels 1-4 of a single sum or product"""
+        operation_type = "summation" if operation_sequence == "S" else "product"
+        return {level: partial(self.single, level, operation_type) for level in (1, 2, 3, 4)}
+
+    def double_routes(self, operation_sequence: str) -> Dict[int, Callable[[], dict]]:
+        """Levels 1-4 of a double sum or double product"""
+        operation_type = "summation" if operation_sequence[0] == "S" else "product"
+        return {
+            1: partial(self.double_level1, operation_type),
+            2: partial(self.doubles.generate_level2, operation_type),
+            3: partial(self.doubles.generate_level3, operation_type),
+            4: partial(self.doubles.generate_level4, operation_type),
+        }
+
+    def mixed_double_routes(self, operation_sequence: str) -> Dict[int, Callable[[], dict]]:
+        """Levels 1-4 of a sum of products or product of sums"""
+        return {level: partial(self.mixed_double, operation_sequence, level) for level in (1, 2, 3, 4)}
+
+    def triple_routes(self, operation_sequence: str) -> Dict[int, Callable[[], dict]]:
+        """Levels 1-3 of a triple operation"""
+        return {
+            1: partial(self.triples.generate_level1, operation_sequence),
+            2: partial(self.triples.generate_level2, operation_sequence),
+            3: partial(self.triples.generate_level3, operation_sequence),
+        }
+
+# Which SumProductGenerator routes serve each problem type
+_PROBLEM_ROUTES = {
+    ProblemType.SINGLE_SUM: SumProductGenerator.single_routes,
+    ProblemType.SINGLE_PRODUCT: SumProductGenerator.single_routes,
+    ProblemType.DOUBLE_SUM: SumProductGenerator.double_routes,
+    ProblemType.DOUBLE_PRODUCT: SumProductGenerator.double_routes,
+    ProblemType.SUM_PRODUCT: SumProductGenerator.mixed_double_routes,
+    ProblemType.PRODUCT_SUM: SumProductGenerator.mixed_double_routes,
+    **{problem: SumProductGenerator.triple_routes
+       for problem, sequence in PROBLEM_SEQUENCES.items() if len(sequence) == 3},
+}
+
+QUESTION_GENERATOR = SumProductGenerator()  # draws from the random module
+
+def question_generator(rng=random) -> SumProductGenerator:
+    """The module singleton for the random module, else a new SumProductGenerator for rng.
+
+    Callers drawing many questions from their own RNG build one generator
+    and pass it along, so per-call RNGs are never cached or kept alive here.
+    """
+    return QUESTION_GENERATOR if rng is random else SumProductGenerator(rng)
+
+def generate_question_instance(operation_sequence: str, level_number: int, rng=random,
+                               generator: SumProductGenerator = None) -> dict:
+    """Draw one random question for an operation sequence and level.
+
+    rng supplies randint/choice; it defaults to the random module. A
+    generator, when given, is drawn from instead of question_generator(rng).
+    """
+    problem = _PROBLEMS_BY_SEQUENCE.get(operation_sequence)
+    if problem is None:
+        raise ValueError(f"Unsupported operation sequence: {operation_sequence}")
+    question = (generator or question_generator(rng)).generate(problem, level_number)
+
+    # Add operation sequence to single operations if not present
+    if 'operation_sequence' not in question:
+        question['operation_sequence'] = operation_sequence
+    return question
+
+RESULT_FORMATS = ('normal_format', 'katex_format', 'html_format')
+
+class QuestionResult(Mapping):
+    """A question with its answer and distractors, read like a dict of formats.
+
+    normal_format, katex_format and html_format are each rendered on first
+    access and cached, so callers only pay for the formats they read;
+    formats limits which of them the result offers. render_text and
+    render_katex write the answer or a distractor in each notation.
+    """
+
+    def __init__(self, question: dict, answer, distractors: list, render_text, render_katex,
+                 mode: str = 'expansion', formats: Tuple[str, ...] = RESULT_FORMATS):
+        unknown = set(formats).difference(RESULT_FORMATS)
+        if unknown:
+            raise ValueError(f"Unknown result formats: {', '.join(sorted(unknown))}")
+        self.question = question
+        self.answer = answer
+        self.distractors = distractors
+        self.mode = mode
+        self._render_text = render_text
+        self._render_katex = render_katex
+        self._keys = (('mode',) if mode == 'numeric' else ()) + tuple(f for f in RESULT_FORMATS if f in formats)
+
+    @cached_property
+    def normal_format(self) -> dict:
+        return {
+            "question": self.question,
+            "correct_expansion": self._render_text(self.answer),
+            "distractors": [self._render_text(d) for d in self.distractors]
+        }
+
+    @cached_property
+    def katex_format(self) -> dict:
+        return {
+            "question": format_question_katex(self.question),
+            "correct_expansion": self._render_katex(self.answer),
+            "distractors": [self._render_katex(d) for d in self.distractors]
+        }
+
+    @cached_property
+    def html_format(self) -> dict:
+        katex = self.katex_format
+        return {
+            "question": generate_katex_html(katex["question"]),
+            "correct_expansion": generate_katex_html(katex["correct_expansion"]),
+            "distractors": [generate_katex_html(d) for d in katex["distractors"]]
+        }
+
+    def __getitem__(self, key: str):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self.mode if key == 'mode' else getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def to_dict(self) -> dict:
+        """Every offered format rendered into a plain dict, e.g. for json.dumps()"""
+        return dict(self)
+
+def numeric_question_value(question: dict, max_bytes: int = None):
+    """The question's exact value, or None when it is symbolic, has an undefined
+    term or may have more digits than the byte budget"""
+    max_bytes = MAX_EXPANSION_BYTES if max_bytes is None else max_bytes
+    cost = estimate_expansion_cost(question)
+    if (compile_expression(question['expression']).symbolic
+            or cost.value_digits('P' in question_operators(question)) > max_bytes):
+        return None
+    try:
+        return evaluate_question_value(question)
+    except (ArithmeticError, ValueError):
+        # An undefined term leaves the question without a value
+        return None
+
+def numeric_question_result(operation_sequence: str, level_number: int, max_bytes: int = None,
+                            rng=random, formats: Tuple[str, ...] = RESULT_FORMATS,
+                            generator: SumProductGenerator = None) -> QuestionResult:
+    """Draw a question whose exact value fits the byte budget and build its result"""
+    for _ in range(MAX_RESAMPLE_ATTEMPTS):
+        question = generate_question_instance(operation_sequence, level_number, rng, generator)
+        value = numeric_question_value(question, max_bytes)
+        if value is not None:
+            return numeric_result(question, value, formats)
+    raise ValueError(f"Could not generate a numeric question within the budget "
+                     f"after {MAX_RESAMPLE_ATTEMPTS} attempts")
+
+def numeric_result(question: dict, value: Fraction, formats: Tuple[str, ...] = RESULT_FORMATS) -> QuestionResult:
+    """Build the numeric-mode result for a question and its exact value"""
+    return QuestionResult(question, value, numeric_distractors(question, value), format_exact_value,
+                          exact_value_katex, 'numeric', formats)
+
+def validate_question_request(prob_number: int, level_number: int, mode: str = 'expansion') -> None:
+    """Raise ValueError for a problem number, level or mode that cannot be generated"""
     if not 1 <= prob_number <= 14:
         raise ValueError("Problem number must be between 1 and 14")
     if not 1 <= level_number <= 4:
         raise ValueError("Level number must be between 1 and 4")
+    if mode not in ('expansion', 'numeric'):
+        raise ValueError(f"Unknown question mode: {mode}")
+
+def draw_question(operation_sequence: str, level_number: int, max_terms: int = None, max_digits: int = None,
+                  max_bytes: int = None, rng=random, generator: SumProductGenerator = None) -> dict:
+    """Draw instances until one fits the expansion budgets"""
+    for _ in range(MAX_RESAMPLE_ATTEMPTS):
+        question = generate_question_instance(operation_sequence, level_number, rng, generator)
+        if not estimate_expansion_cost(question).exceeds(max_terms, max_digits, max_bytes):
+            return question
+    raise ValueError(f"Could not generate a question within the expansion budget "
+                     f"after {MAX_RESAMPLE_ATTEMPTS} attempts")
+
+def expansion_result(question: dict, expansion_tree: TermGroup, fold_terms: int = None, exact: bool = False,
+                     formats: Tuple[str, ...] = RESULT_FORMATS):
+    """Expand common mistakes into distractors; every output format is a walk over the same trees.
+
+    None when the question has fewer than three distinct distractors. With
+    fold_terms a streamed tree is walked once, into the folded tree every
+    format then renders.
+    """
+    return expansion_results([question], [expansion_tree], fold_terms, exact, formats)[0]
+
+def expansion_results(questions: List[dict], expansion_trees: List[TermGroup], fold_terms: int = None,
+                      exact: bool = False, formats: Tuple[str, ...] = RESULT_FORMATS) -> list:
+    """expansion_result() for many questions, with their distractors from one batch_distractors() call"""
+    if fold_terms:
+        expansion_trees = [fold_term_tree(tree, fold_terms) for tree in expansion_trees]
+    katex = {}  # tree -> KaTeX; each tree is rendered once, for deduplication and for katex_format
+    
+    def render_katex(tree) -> str:
+        if tree not in katex:
+            katex[tree] = term_tree_to_katex(tree)
+        return katex[tree]
+    
+    distractor_sets = batch_distractors(expansion_trees, questions, fold_terms, exact, render_katex)
+    return [QuestionResult(question, tree, distractor_trees, term_tree_to_text, render_katex, formats=formats)
+            if len(distractor_trees) == 3 else None
+            for question, tree, distractor_trees in zip(questions, expansion_trees, distractor_sets)]
+
+def draw_expansion_result(operation_sequence: str, level_number: int, max_terms: int = None,
+                          max_digits: int = None, max_bytes: int = None, fold_terms: int = None,
+                          exact: bool = False, rng=random, formats: Tuple[str, ...] = RESULT_FORMATS,
+                          generator: SumProductGenerator = None) -> QuestionResult:
+    """Draw instances until one fits the budgets and has three distinct distractors"""
+    for _ in range(MAX_RESAMPLE_ATTEMPTS):
+        question = draw_question(operation_sequence, level_number, max_terms, max_digits,
+                                 math.inf if fold_terms else max_bytes, rng, generator)
+        expansion_tree = stream_expansion(question, exact) if fold_terms else generate_expansion(question, exact)
+        result = expansion_result(question, expansion_tree, fold_terms, exact, formats)
+        if result is not None:
+            return result
+    raise ValueError(f"Could not generate a question with three distinct distractors "
+                     f"after {MAX_RESAMPLE_ATTEMPTS} attempts")
+
+def aqg_sums_and_products(prob_number: int, level_number: int, max_terms: int = None,
+                          max_digits: int = None, max_bytes: int = None, fold_terms: int = None,
+                          mode: str = 'expansion', exact: bool = False,
+                          formats: Tuple[str, ...] = RESULT_FORMATS) -> QuestionResult:
+    """Main interface function for auto question generation.
+
+    Instances whose estimated expansion exceeds the term, digit or byte budget
+    are redrawn before anything is expanded; the budgets default to
+    MAX_EXPANSION_TERMS, MAX_TERM_DIGITS and MAX_EXPANSION_BYTES. With
+    fold_terms the expansion is streamed and every group longer than
+    2 * fold_terms is shown as its first and last fold_terms terms, so the
+    byte budget no longer applies.
+
+    With exact, non-integer terms are exact fractions (\\frac in KaTeX)
+    rather than rounded floats.
+
+    mode='numeric' asks for the value of the sum or product instead; it is
+    computed exactly with evaluate_question_value() and only the byte budget
+    applies, to the digits of the value.
+
+    The result renders each of RESULT_FORMATS on first access; formats
+    narrows it to the ones the caller needs.
+    """
+    validate_question_request(prob_number, level_number, mode)
 
     # Get operation sequence
     operation_sequence = get_operation_sequence(prob_number)
     
-    # Determine the number of operations based on operation_sequence length
-    num_operations = len(operation_sequence)
-    
-    # Generate question based on the number of operations
-    if num_operations == 1:
-        question = generate_question_by_level(level_number, 
-                                             "summation" if operation_sequence == "S" else "product")
-    elif num_operations == 2:
-        if operation_sequence in ["SS", "PP"]:
-            # Double summation or double product
-            question = generate_double_question_by_level(level_number, 
-                                                         "summation" if operation_sequence[0] == "S" else "product")
-        else:
-            # Mixed operations (e.g., "SP", "PS")
-            question = generate_mixed_double_question_by_level(operation_sequence, level_number)
-    elif num_operations == 3:
-        question = generate_triple_question(operation_sequence, level_number)
-    else:
-        raise ValueError(f"Unsupported number of operations: {num_operations}")
-
-    # Add operation sequence to single operations if not present
-    if 'operation_sequence' not in question:
-        question['operation_sequence'] = operation_sequence
-
-    # Generate correct expansion and distractors
-    correct_expansion = generate_expansion(question)
-    distractors = generate_distractors(correct_expansion, question)
-
-    return {
-        "normal_format": {
-            "question": question,
-            "correct_expansion": correct_expansion,
-            "distractors": distractors
-        },
-        "katex_format": {
-            "question": format_question_katex(question),
-            "correct_expansion": convert_to_katex(correct_expansion),
-            "distractors": [convert_to_katex(d) for d in distractors]
-        },
-        "html_format": {
-            "question": generate_katex_html(format_question_katex(question)),
-            "correct_expansion": generate_katex_html(convert_to_katex(correct_expansion)),
-            "distractors": [generate_katex_html(convert_to_katex(d)) for d in distractors]
-        }
-    }
+    if mode == 'numeric':
+        return numeric_question_result(operation_sequence, level_number, max_bytes, formats=formats)
+    
+    return draw_expansion_result(operation_sequence, level_number, max_terms, max_digits, max_bytes,
+                                 fold_terms, exact, formats=formats)
 
 def format_mathematical_output(result: dict) -> str:
     """Format the question and expansions in mathematical notation"""
@@ -1325,9 +2605,15 @@ def format_mathematical_output(result: dict) -> str:
     return "\n".join(output)
 
 
-def generate_single_katex_html(math_expression: str, is_question: bool = False, mermaid_code: str | None = None) -> str:
+_KATEX_STYLESHEET = 'https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css'
+_KATEX_SCRIPT = 'https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js'
+# Declared once per payload in fragment mode instead of in every option's document
+_FRAGMENT_ASSETS = {"stylesheets": [_KATEX_STYLESHEET], "scripts": [_KATEX_SCRIPT]}
+
+def generate_single_katex_html(math_expression: str, is_question: bool = False, mermaid_code: str | None = None,
+                               prompt: str = "Expand the below equation:") -> str:
     """Generate flat/minified HTML with KaTeX and optional Mermaid, suitable for JSON embedding"""
-    instruction = f'<p>Expand the below equation:${math_expression}$</p>' if is_question else ''
+    instruction = f'<p>{prompt}${math_expression}$</p>' if is_question else ''
     
     mermaid_code = """
     erDiagram
@@ -1360,25 +2646,39 @@ def generate_single_katex_html(math_expression: str, is_question: bool = False,
 
     return (
         "<!DOCTYPE html><html><head><meta charset='UTF-8'>"
-        "<link rel='stylesheet' href='https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css'>"
-        "<script src='https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js'></script>"
+        f"<link rel='stylesheet' href='{_KATEX_STYLESHEET}'>"
+        f"<script src='{_KATEX_SCRIPT}'></script>"
         "</head><body>"
         f"{instruction}{mermaid_block}{chartjs_block}{katex_script}"
         "</body></html>"
     )
 
-def generate_json_output(result: dict) -> str:
-    """Generate JSON output with properly escaped KaTeX expressions"""
+def generate_katex_fragment(math_expression: str, is_question: bool = False,
+                            prompt: str = "Expand the below equation:") -> str:
+    """Minimal HTML for one expression; fragment payloads declare the KaTeX assets once"""
+    return f'<p>{prompt}${math_expression}$</p>' if is_question else f'${math_expression}$'
+
+_JSON_OUTPUT_FORMATS = ('katex_format',)  # the only result format generate_json_output() reads
+
+def generate_json_output(result: dict, rng=random, fragments: bool = False) -> str:
+    """Generate JSON output with properly escaped KaTeX expressions.
+
+    By default the question and every option are complete HTML documents.
+    With fragments they are minimal math fragments, and the KaTeX assets are
+    listed once under "assets"; the preview page renders either form.
+    """
     # Generate HTML for question and answers
-    question_html = generate_single_katex_html(result['katex_format']['question'], is_question=True)
-    correct_answer_html = generate_single_katex_html(result['katex_format']['correct_expansion'])
-    distractor_htmls = [generate_single_katex_html(d) for d in result['katex_format']['distractors']]
+    prompt = "Evaluate the below expression:" if result.get('mode') == 'numeric' else "Expand the below equation:"
+    render = generate_katex_fragment if fragments else generate_single_katex_html
+    question_html = render(result['katex_format']['question'], is_question=True, prompt=prompt)
+    correct_answer_html = render(result['katex_format']['correct_expansion'])
+    distractor_htmls = [render(d) for d in result['katex_format']['distractors']]
     
     # Create list of all options
     all_options = [correct_answer_html] + distractor_htmls
     
     # Randomly shuffle the options
-    random.shuffle(all_options)
+    rng.shuffle(all_options)
     
     # Find the index of correct answer in shuffled options
     correct_answer_index = all_options.index(correct_answer_html)
@@ -1389,27 +2689,347 @@ def generate_json_output(result: dict) -> str:
         "options": all_options,
         "correctAnswer": correct_answer_index
     }
+    if fragments:
+        output_dict = {"format": "fragment", "assets": _FRAGMENT_ASSETS, **output_dict}
     
     # Use json.dumps with ensure_ascii=False and without escaping HTML quotes
     return json.dumps(output_dict, ensure_ascii=False).replace('\\"', '"')
 
 # Modify the main execution block to return JSON when called via API
-def generate_question(prob_number: int, level_number: int) -> str:
-    """Main function to generate question and return JSON output"""
+def generate_question(prob_number: int, level_number: int, mode: str = 'expansion',
+                      fragments: bool = False) -> str:
+    """Main function to generate question and return JSON output; see
+    generate_json_output() for fragments"""
     try:
         if not (1 <= prob_number <= 14 and 1 <= level_number <= 4):
             raise ValueError("Problem number must be 1-14 and level must be 1-4")
         
         # Generate question
-        result = aqg_sums_and_products(prob_number, level_number)
+        result = aqg_sums_and_products(prob_number, level_number, mode=mode, formats=_JSON_OUTPUT_FORMATS)
         # print(result)
         # Convert to required JSON format
-        return generate_json_output(result)
+        return generate_json_output(result, fragments=fragments)
         
     except ValueError as e:
         import json
         return json.dumps({"error": str(e)})
 
+_DRAWS_PER_QUESTION = 24  # uniforms drawn up front per question in a batch; more are drawn on demand
+
+class BatchRandom:
+    """The randint/choice/shuffle subset of the random module, served from
+    uniforms drawn from a NumPy Generator a block at a time"""
+    __slots__ = ('generator', 'block_size', '_block', '_position')
+
+    def __init__(self, generator: np.random.Generator, block_size: int):
+        self.generator = generator
+        self.block_size = max(block_size, 1)
+        self._block = []
+        self._position = 0
+
+    def random(self) -> float:
+        if self._position == len(self._block):
+            self._block = self.generator.random(self.block_size).tolist()
+            self._position = 0
+        value = self._block[self._position]
+        self._position += 1
+        return value
+
+    def randint(self, a: int, b: int) -> int:
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+    def shuffle(self, items: list) -> None:
+        for position in reversed(range(1, len(items))):
+            other = int(self.random() * (position + 1))
+            items[position], items[other] = items[other], items[position]
+
+def generate_questions(prob_number: int, level_number: int, n: int, seed: int = None,
+                       mode: str = 'expansion', lazy: bool = False, fragments: bool = False):
+    """Generate n questions as JSON strings, like n calls to generate_question().
+
+    Every random parameter comes from one NumPy Generator seeded with seed, so
+    a seeded batch is reproducible. All instances are drawn before anything is
+    expanded: expand_questions() evaluates the answers sharing an expression
+    template together, and batch_distractors() expands every question's
+    mistakes in shared rounds. With lazy, an iterator renders each question's
+    JSON only when it is consumed. Raises ValueError for invalid arguments.
+    """
+    validate_question_request(prob_number, level_number, mode)
+    if n < 0:
+        raise ValueError("Question count must not be negative")
+    
+    operation_sequence = get_operation_sequence(prob_number)
+    rng = BatchRandom(np.random.default_rng(seed), n * _DRAWS_PER_QUESTION)
+    generator = SumProductGenerator(rng)  # one per batch, released with it
+    if mode == 'numeric':
+        results = (numeric_question_result(operation_sequence, level_number, rng=rng, formats=_JSON_OUTPUT_FORMATS,
+                                           generator=generator)
+                   for _ in range(n))
+    else:
+        questions = [draw_question(operation_sequence, level_number, rng=rng, generator=generator) for _ in range(n)]
+        # The rare instance without three distinct distractors is replaced by a fresh draw
+        results = (result or draw_expansion_result(operation_sequence, level_number, rng=rng,
+                                                   formats=_JSON_OUTPUT_FORMATS, generator=generator)
+                   for result in expansion_results(questions, expand_questions(questions),
+                                                   formats=_JSON_OUTPUT_FORMATS))
+    outputs = (generate_json_output(result, rng, fragments) for result in results)
+    return outputs if lazy else list(outputs)
+
+class QuestionSpace:
+    """Every distinct question of one (operation sequence, level), indexable in O(1).
+
+    The space is the product of its factors: an index is decoded in mixed
+    radix, last factor fastest, and build() turns the chosen values into the
+    question dict the generators would produce.
+    """
+    __slots__ = ('factors', 'build', 'size')
+
+    def __init__(self, factors, build):
+        self.factors = tuple(tuple(factor) for factor in factors)
+        self.build = build
+        self.size = math.prod(len(factor) for factor in self.factors)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: int) -> dict:
+        if not 0 <= index < self.size:
+            raise IndexError(f"Question index {index} outside a space of {self.size}")
+        values = []
+        for factor in reversed(self.factors):
+            index, digit = divmod(index, len(factor))
+            values.append(factor[digit])
+        return self.build(*reversed(values))
+
+# Parameter values the generators draw from, as (choices) per factor
+_SIGNED_BOUNDS = tuple(range(-5, 0)) + tuple(range(1, 6))  # randint(-5, -1) or randint(1, 5)
+_COMPLEX_EXPRESSIONS = {  # ExpressionGenerator.generate_complex_expression()
+    'product': ("i", "i/2", "(2*i - 1)/i", "(i + 1)/i"),
+    'summation': ("i^2", "sqrt(i)", "ln(i)", "(2*i - 1)", "(i^2 - 3)"),
+}
+_DOUBLE_EXPRESSIONS = {  # DoubleOperationGenerator, by level
+    1: ("i+j", "i*j", "i^j", "2*i*j", "3*i*j", "4*i*j", "i^2 + j^2"),
+    2: ("i+j", "i^j", "2^(i+j)", "2*i^2 - j", "3*i^2 - j", "4*i^2 - j"),
+    3: ("i+j", "(i+j)^2"),
+    4: ("i+j", "(i+j)^2"),
+}
+_MIXED_EXPRESSIONS = ("i+j", "i*j", "i^j", "2*i*j", "3*i*j", "4*i*j", "i^2 + j^2", "(i+j)^2", "ln(i+j)")
+_TRIPLE_EXPRESSIONS = {  # TripleOperationGenerator, by level
+    1: ("i+j+k", "i^j*k", "2*i^2 - j + k", "3*i^2 - j + k"),
+    2: ("i+j+k", "(i*j)/k", "(i-j)^k"),
+}
+_TRIPLE_CORRELATED_STARTS = (  # (middle_start, inner_start) of TripleOperationGenerator.generate_level3()
+    ("i+1", "1"), ("i+2", "1"), ("1", "i-1"), ("1", "i-2"), ("1", "j+1"), ("1", "j+2"),
+    ("i+1", "j-1"), ("i+1", "j-2"), ("i+2", "j-1"), ("i+2", "j-2"),
+)
+
+def _single_bounds(level: int, operation_type: str) -> tuple:
+    """(starts, ends) drawn by generate_question_by_level()"""
+    if level == 1:
+        return (1,), range(3, 6)
+    if level == 2:
+        return range(-5, 0), range(1, 6)
+    if operation_type == "product":
+        return range(-4, 0), range(2, 5)
+    return range(-8, -2), range(3, 9)
+
+def _single_space(operation_sequence: str, level: int) -> QuestionSpace:
+    operation_type = "summation" if operation_sequence == "S" else "product"
+    expressions = {1: ("i",), 2: ("i^2",)}.get(level, _COMPLEX_EXPRESSIONS[operation_type])
+    return QuestionSpace((*_single_bounds(level, operation_type), expressions), lambda start, end, expression: {
+        "outer_start": str(start),
+        "outer_end": str(end),
+        "expression": expression,
+        "type": operation_type,
+        "operation_sequence": operation_sequence
+    })
+
+def _double_space(operation_sequence: str, level: int) -> QuestionSpace:
+    operation_type = "summation" if operation_sequence[0] == "S" else "product"
+    
+    def question(expression, outer_start, outer_end, inner_start, inner_end) -> dict:
+        return {
+            "expression": expression,
+            "outer_start": outer_start,
+            "outer_end": outer_end,
+            "inner_start": inner_start,
+            "inner_end": inner_end,
+            "type": f"double_{operation_type}",
+            "level": level,
+            "correlated": level > 2,
+            "operation_sequence": operation_sequence
+        }
+    
+    expressions = _DOUBLE_EXPRESSIONS[level]
+    if level == 1:
+        # generate_double_question_by_level() redraws both ends as integers
+        return QuestionSpace((expressions, range(3, 6), range(4, 7)),
+                             lambda expression, outer_end, inner_end:
+                             question(expression, "1", outer_end, "1", inner_end))
+    if level == 2:
+        return QuestionSpace((_SIGNED_BOUNDS,) * 4 + (expressions,),
+                             lambda outer_start, outer_end, inner_start, inner_end, expression:
+                             question(expression, str(outer_start), str(outer_end), str(inner_start), str(inner_end)))
+    # The inner end lies 1 to 3 past the outer end (its absolute value at level 4)
+    outer_starts = (1,) if level == 3 else range(-5, 0)
+    outer_ends = range(3, 6) if level == 3 else range(1, 6)
+    return QuestionSpace((("+", "-"), (1, 2), outer_starts, outer_ends, (1, 2, 3), expressions),
+                         lambda correlation, offset, outer_start, outer_end, gap, expression:
+                         question(expression, str(outer_start), str(outer_end), f"i{correlation}{offset}",
+                                  str(abs(outer_end) + gap)))
+
+def _mixed_double_space(operation_sequence: str, level: int) -> QuestionSpace:
+    outer_starts, outer_ends = _single_bounds(level, "summation" if operation_sequence[0] == "S" else "product")
+    inner_starts, inner_ends = _single_bounds(level, "summation" if operation_sequence[1] == "S" else "product")
+    return QuestionSpace((outer_starts, outer_ends, inner_starts, inner_ends, _MIXED_EXPRESSIONS),
+                         lambda outer_start, outer_end, inner_start, inner_end, expression: {
+                             "outer_start": str(outer_start),
+                             "outer_end": str(outer_end),
+                             "inner_start": str(inner_start),
+                             "inner_end": str(inner_end),
+                             "expression": expression,
+                             "type": operation_sequence,
+                             "level": level,
+                             "operation_sequence": operation_sequence
+                         })
+
+def _triple_space(operation_sequence: str, level: int) -> QuestionSpace:
+    if level not in (1, 2, 3):
+        raise ValueError(f"Invalid level: {level}. Supported levels are 1-3")
+    
+    def question(expression, bounds, correlated) -> dict:
+        return {
+            "expression": expression,
+            "outer_start": str(bounds[0]),
+            "outer_end": str(bounds[1]),
+            "middle_start": str(bounds[2]),
+            "middle_end": str(bounds[3]),
+            "inner_start": str(bounds[4]),
+            "inner_end": str(bounds[5]),
+            "operation_sequence": operation_sequence,
+            "level": level,
+            "correlated": correlated
+        }
+    
+    if level == 1:
+        return QuestionSpace((_TRIPLE_EXPRESSIONS[1],),
+                             lambda expression: question(expression, (1, 4, 1, 5, 1, 6), False))
+    if level == 2:
+        return QuestionSpace((_SIGNED_BOUNDS,) * 6 + (_TRIPLE_EXPRESSIONS[2],),
+                             lambda *values: question(values[-1], values[:-1], False))
+    return QuestionSpace((_TRIPLE_CORRELATED_STARTS, range(-2, 3), range(3, 7), range(4, 8), range(5, 9)),
+                         lambda starts, outer_start, outer_end, middle_end, inner_end:
+                         question("(i-j)^k", (outer_start, outer_end, starts[0], middle_end, starts[1], inner_end),
+                                  True))
+
+@lru_cache(maxsize=64)
+def question_space(prob_number: int, level_number: int) -> QuestionSpace:
+    """The enumerated question space of a problem number and level.
+
+    It holds each question generate_question_instance() can draw exactly once,
+    so indexing it uniformly samples distinct questions; the generators
+    themselves weight some questions more than others.
+    """
+    validate_question_request(prob_number, level_number)
+    operation_sequence = get_operation_sequence(prob_number)
+    if len(operation_sequence) == 1:
+        return _single_space(operation_sequence, level_number)
+    if len(operation_sequence) == 3:
+        return _triple_space(operation_sequence, level_number)
+    if operation_sequence in ("SS", "PP"):
+        return _double_space(operation_sequence, level_number)
+    return _mixed_double_space(operation_sequence, level_number)
+
+_FEISTEL_ROUNDS = 6  # rounds of the keyed permutation; four already give a pseudo-random one
+_MASK_64 = (1 << 64) - 1
+
+class FeistelPermutation:
+    """Keyed pseudo-random permutation of range(size) in O(1) time and memory.
+
+    A balanced Feistel network permutes the smallest even bit width covering
+    size; cycle walking re-applies it until the value falls below size, which
+    keeps the map a bijection on range(size).
+    """
+    __slots__ = ('size', 'half_bits', 'half_mask', 'round_keys')
+
+    def __init__(self, size: int, key):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        digest = hashlib.blake2b(str(key).encode(), digest_size=8 * _FEISTEL_ROUNDS).digest()
+        self.round_keys = [int.from_bytes(digest[8 * r:8 * r + 8], 'little') for r in range(_FEISTEL_ROUNDS)]
+
+    def _round(self, value: int, round_key: int) -> int:
+        # splitmix64 finaliser of the half block mixed with the round key
+        value = (value ^ round_key) & _MASK_64
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK_64
+        return (value ^ (value >> 31)) & self.half_mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ self._round(right, round_key)
+        return (left << self.half_bits) | right
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self.size:
+            raise IndexError(f"Permutation index {index} outside range({self.size})")
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+class QuestionSampler:
+    """A never-repeating order over a question space, fixed by a key such as a
+    student or session id; position n is the n-th question that key sees"""
+    __slots__ = ('space', 'permutation')
+
+    def __init__(self, space: QuestionSpace, key):
+        self.space = space
+        self.permutation = FeistelPermutation(len(space), key)
+
+    def __len__(self) -> int:
+        return len(self.space)
+
+    def __getitem__(self, position: int) -> dict:
+        return self.space[self.permutation[position]]
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+def generate_sampled_question(prob_number: int, level_number: int, key, position: int = 0,
+                              mode: str = 'expansion', fragments: bool = False) -> tuple:
+    """JSON for the question at position in key's never-repeating sequence, and the next position.
+
+    Questions outside the expansion (or, in numeric mode, value) budgets, or
+    without three distinct distractors, are skipped, so a caller that stores only the returned position never sees a
+    repeat. Distractors and option order are seeded by key and position.
+    Raises ValueError once the sequence is exhausted.
+    """
+    validate_question_request(prob_number, level_number, mode)
+    sampler = QuestionSampler(question_space(prob_number, level_number), key)
+    for position in range(position, len(sampler)):
+        question = sampler[position]
+        rng = random.Random(f"{key}:{position}")
+        if mode == 'numeric':
+            value = numeric_question_value(question)
+            if value is not None:
+                result = numeric_result(question, value, _JSON_OUTPUT_FORMATS)
+                return generate_json_output(result, rng, fragments), position + 1
+        elif not estimate_expansion_cost(question).exceeds():
+            result = expansion_result(question, generate_expansion(question), formats=_JSON_OUTPUT_FORMATS)
+            if result is not None:
+                return generate_json_output(result, rng, fragments), position + 1
+    raise ValueError(f"All {len(sampler)} questions of problem {prob_number} "
+                     f"at level {level_number} have been used")
+
 if __name__ == "__main__":
     # Generate and print properly formatted JSON
     output = generate_question(1, 3)
@@ -1,18 +1,201 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, Response, stream_with_context
 import os
-import importlib.util
 from werkzeug.utils import secure_filename
-from tempfile import NamedTemporaryFile
 import json
+import atexit
+import hashlib
+import py_compile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from module_registry import ModuleRegistry
+from worker_pool import WorkerPool, InlineExecutor, GeneratorNotFound, read_source
+from reservoir import ReservoirManager
+from metrics import MetricsRegistry, PhaseTimer, bounded_label
+from upload_store import UploadStore
+from import_profile import profile_import
 
 UPLOAD_FOLDER = 'static/uploaded'
 ALLOWED_EXTENSIONS = {'py'}
+MODULE_CACHE_SIZE = 32
+MODULE_CACHE_TTL = 600  # seconds a loaded generator may sit idle before eviction
+MAX_BATCH_COUNT = 1000
+WORKER_POOL_SIZE = os.cpu_count() or 1  # 0 runs generators on the request thread
+WORKER_TIMEOUT = 10  # seconds per generate_question() call
+WORKER_MAX_CALLS = 500  # recycle a worker after this many calls
+WORKER_MAX_RSS_MB = 512  # recycle a worker once its resident memory exceeds this
+RESERVOIR_SIZE = 16  # ready questions kept per (module, type, level); 0 disables
+RESERVOIR_LOW_WATER = 4  # refill a reservoir once it holds fewer than this
+RESERVOIR_REFILL_WORKERS = 2  # concurrent background refills
+RESERVOIR_MAX_KEYS = 64  # most recently used (module, type, level) reservoirs kept
+SEEDED_CACHE_MAX_AGE = 31536000  # seeded previews never change for a given module
+IMPORT_PROFILE_TIMEOUT = 60  # seconds allowed for profiling an upload's import
+MAX_MATRIX_CELLS = 200
+QUESTION_LEVELS = (1, 2, 3, 4)  # levels the generators accept
+QUESTION_TYPES = tuple(range(1, 15))  # problem numbers the generators accept
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MODULE_CACHE_SIZE'] = MODULE_CACHE_SIZE
+app.config['MODULE_CACHE_TTL'] = MODULE_CACHE_TTL
+app.config['MAX_BATCH_COUNT'] = MAX_BATCH_COUNT
+app.config['WORKER_POOL_SIZE'] = WORKER_POOL_SIZE
+app.config['WORKER_TIMEOUT'] = WORKER_TIMEOUT
+app.config['WORKER_MAX_CALLS'] = WORKER_MAX_CALLS
+app.config['WORKER_MAX_RSS_MB'] = WORKER_MAX_RSS_MB
+app.config['RESERVOIR_SIZE'] = RESERVOIR_SIZE
+app.config['RESERVOIR_LOW_WATER'] = RESERVOIR_LOW_WATER
+app.config['RESERVOIR_REFILL_WORKERS'] = RESERVOIR_REFILL_WORKERS
+app.config['RESERVOIR_MAX_KEYS'] = RESERVOIR_MAX_KEYS
+app.config['SEEDED_CACHE_MAX_AGE'] = SEEDED_CACHE_MAX_AGE
+app.config['IMPORT_PROFILE_TIMEOUT'] = IMPORT_PROFILE_TIMEOUT
+app.config['MAX_MATRIX_CELLS'] = MAX_MATRIX_CELLS
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+upload_store = UploadStore(app.config['UPLOAD_FOLDER'])
+
+module_registry = ModuleRegistry(app.config['MODULE_CACHE_SIZE'], app.config['MODULE_CACHE_TTL'])
+
+if app.config['WORKER_POOL_SIZE'] > 0:
+    executor = WorkerPool(
+        size=app.config['WORKER_POOL_SIZE'],
+        timeout=app.config['WORKER_TIMEOUT'],
+        max_calls=app.config['WORKER_MAX_CALLS'],
+        max_rss_mb=app.config['WORKER_MAX_RSS_MB'],
+        cache_size=app.config['MODULE_CACHE_SIZE'],
+        cache_ttl=app.config['MODULE_CACHE_TTL'],
+    )
+else:
+    executor = InlineExecutor(module_registry)
+atexit.register(executor.shutdown)
+
+# Threads that fan matrix cells out to the workers; each one blocks on a single worker
+matrix_threads = ThreadPoolExecutor(max_workers=max(app.config['WORKER_POOL_SIZE'], 1),
+                                    thread_name_prefix='preview-matrix')
+atexit.register(matrix_threads.shutdown, wait=False)
+
+# Import profiling runs a fresh interpreter per upload, so it happens off the request thread
+profile_threads = ThreadPoolExecutor(max_workers=1, thread_name_prefix='import-profile')
+atexit.register(profile_threads.shutdown, wait=False)
+profiling = set()  # digests whose profile is being computed
+profiling_lock = threading.Lock()
+
+metrics = MetricsRegistry()
+request_phases = metrics.histogram(
+    'aq_request_phase_seconds',
+    'Time spent in each phase of a request.',
+    ('endpoint', 'module', 'level', 'phase'),
+)
+# Level label values; any other requested level is counted as 'other'
+METRIC_LEVELS = frozenset(str(level) for level in QUESTION_LEVELS)
+
+def level_label(question_level) -> str:
+    return bounded_label(question_level, METRIC_LEVELS)
+
+generator_phases = metrics.histogram(
+    'aq_generator_phase_seconds',
+    'Time spent dispatching, importing, running and validating uploaded generators.',
+    ('module', 'level', 'phase'),
+)
+
+def produce(digest, path, question_type, question_level, seed=None, fragments=False):
+    """Generate one question through the executor and record its phase timings."""
+    timings = {}
+    start = time.perf_counter()
+    try:
+        return executor.generate(digest, path, question_type, question_level, timings=timings, seed=seed,
+                                 fragments=fragments)
+    finally:
+        labels = (digest[:12], level_label(question_level))
+        worker_seconds = 0.0
+        for phase in ('import', 'generate', 'validate'):
+            if phase in timings:
+                generator_phases.observe(labels + (phase,), timings[phase])
+                worker_seconds += timings[phase]
+        # Whatever the worker did not account for is queueing and pipe overhead
+        generator_phases.observe(labels + ('dispatch',), time.perf_counter() - start - worker_seconds)
+
+if app.config['RESERVOIR_SIZE'] > 0:
+    reservoirs = ReservoirManager(
+        produce,
+        size=app.config['RESERVOIR_SIZE'],
+        low_water=app.config['RESERVOIR_LOW_WATER'],
+        refill_workers=app.config['RESERVOIR_REFILL_WORKERS'],
+        max_keys=app.config['RESERVOIR_MAX_KEYS'],
+    )
+    atexit.register(reservoirs.shutdown)
+else:
+    reservoirs = None
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return hits / total if total else 0
+
+def _module_cache_hit_ratio():
+    stats = executor.stats()
+    return _ratio(stats['module_hits'], stats['module_misses'])
+
+def _reservoir_hit_ratio():
+    if reservoirs is None:
+        return 0
+    stats = reservoirs.stats()
+    return _ratio(stats['hits'], stats['misses'])
+
+metrics.gauge('aq_module_cache_hit_ratio', 'Share of generator calls served by an already loaded module.',
+              _module_cache_hit_ratio)
+metrics.gauge('aq_reservoir_hit_ratio', 'Share of previews served from a ready reservoir question.',
+              _reservoir_hit_ratio)
+metrics.gauge('aq_worker_queue_depth', 'Requests waiting for a free generator worker.', executor.queue_depth)
+metrics.gauge('aq_worker_idle', 'Generator workers currently idle.', lambda: executor.stats().get('idle', 0))
+
+def output_response(result):
+    """Wrap a validated generator JSON string as the preview response without re-encoding it."""
+    return Response('{"output":' + result + '}', mimetype='application/json')
+
+def resolve_digest(path):
+    """Digest of the generator at ``path``; content-addressed uploads are not re-read."""
+    digest = upload_store.resolve(path)
+    if digest is None:
+        digest, _ = read_source(path)
+    return digest
+
+def preview_etag(digest, question_type, question_level, seed, fragments=False):
+    """Strong ETag for a seeded preview; the output is fully determined by these inputs."""
+    key = f'{digest}:{question_type}:{question_level}:{seed}'
+    if fragments:
+        key += ':fragments'
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def parse_flag(value):
+    """Boolean request field; JSON booleans or true/1/yes as query strings."""
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+def schedule_profile(digest, bytecode):
+    """Profile the upload's import in the background unless a run is already queued."""
+    with profiling_lock:
+        if digest in profiling:
+            return
+        profiling.add(digest)
+
+    def run():
+        try:
+            upload_store.save_profile(digest, profile_import(bytecode, timeout=app.config['IMPORT_PROFILE_TIMEOUT']))
+        finally:
+            with profiling_lock:
+                profiling.discard(digest)
+
+    try:
+        profile_threads.submit(run)
+    except RuntimeError:
+        # Executor already shut down
+        with profiling_lock:
+            profiling.discard(digest)
+
+PENDING_PROFILE = {'status': 'pending'}
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -22,6 +205,7 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    timer = PhaseTimer()
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
@@ -29,62 +213,230 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        return jsonify({'message': 'File uploaded', 'path': file_path})
+        digest, file_path, created = upload_store.save(file.stream, filename)
+        timer.mark('store')
+
+        try:
+            bytecode = upload_store.compile(digest)
+        except py_compile.PyCompileError as e:
+            # Nothing that failed to compile stays previewable
+            upload_store.discard(digest, filename)
+            return jsonify({'error': f'Invalid Python source: {e.exc_value}', 'hash': digest}), 400
+        timer.mark('compile')
+
+        profile = upload_store.load_profile(digest)
+        if profile is None:
+            schedule_profile(digest, bytecode)
+            profile = PENDING_PROFILE
+        timer.mark('profile')
+
+        response = jsonify({
+            'message': 'File uploaded' if created else 'File already uploaded',
+            'path': file_path,
+            'hash': digest,
+            'import_profile': profile,
+        })
+        timer.mark('encode')
+        timer.finish(request_phases, 'upload', digest[:12], '-')
+        return response
     return jsonify({'error': 'Invalid file type'}), 400
 
-@app.route('/preview-auto-question', methods=['POST'])
+@app.route('/upload/<digest>/profile')
+def upload_profile(digest):
+    """Import profile of a stored upload; 202 with a pending status while it is computed."""
+    if not upload_store.has(digest):
+        return jsonify({'error': 'Unknown upload'}), 404
+    profile = upload_store.load_profile(digest)
+    if profile is None:
+        bytecode = upload_store.bytecode_path(digest)
+        if os.path.exists(bytecode):
+            schedule_profile(digest, bytecode)
+        return jsonify({'hash': digest, 'import_profile': PENDING_PROFILE}), 202
+    return jsonify({'hash': digest, 'import_profile': profile})
+
+@app.route('/preview-auto-question', methods=['GET', 'POST'])
 def preview_auto_question():
+    timer = PhaseTimer()
+    try:
+        # GET carries the same fields as query parameters so seeded previews are cacheable
+        data = request.get_json() if request.method == 'POST' else request.args
+        uploaded_file_path = data.get('path')
+        try:
+            question_type = int(data.get('question_type', 1))
+            question_level = int(data.get('question_level', 1))
+            seed = data.get('seed')
+            seed = int(seed) if seed is not None else None
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        # Opt-in compact output: minimal math fragments with the KaTeX assets declared once
+        fragments = parse_flag(data.get('fragments', False))
+
+        if not uploaded_file_path or not os.path.exists(uploaded_file_path):
+            return jsonify({'error': 'Uploaded file not found'}), 400
+        # A GET can come from any cross-site link, so it may only run stored uploads
+        if request.method == 'GET' and upload_store.resolve(uploaded_file_path) is None:
+            return jsonify({'error': 'GET previews only accept stored upload paths'}), 400
+
+        timer.mark('parse')
+
+        digest = resolve_digest(uploaded_file_path)
+        timer.mark('read')
+
+        if seed is not None:
+            etag = preview_etag(digest, question_type, question_level, seed, fragments)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            result = produce(digest, uploaded_file_path, question_type, question_level, seed, fragments)
+        elif reservoirs is not None and not fragments:
+            # Reservoirs hold full documents only
+            result = reservoirs.get(digest, uploaded_file_path, question_type, question_level)
+        else:
+            result = produce(digest, uploaded_file_path, question_type, question_level, fragments=fragments)
+        timer.mark('produce')
+
+        response = output_response(result)
+        if seed is not None:
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['SEEDED_CACHE_MAX_AGE']
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_store = True
+        timer.mark('encode')
+        timer.finish(request_phases, 'preview', digest[:12], level_label(question_level))
+        return response
+
+    except GeneratorNotFound as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(e)    
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/preview-auto-question/batch', methods=['POST'])
+def preview_auto_question_batch():
+    """Stream `count` generated questions as NDJSON, one line per question."""
     try:
         data = request.get_json()
         uploaded_file_path = data.get('path')
         question_type = int(data.get('question_type', 1))
         question_level = int(data.get('question_level', 1))
+        count = int(data.get('count', 1))
+        fragments = parse_flag(data.get('fragments', False))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
 
-        if not os.path.exists(uploaded_file_path):
-            return jsonify({'error': 'Uploaded file not found'}), 400
+    if not 1 <= count <= app.config['MAX_BATCH_COUNT']:
+        return jsonify({'error': f"count must be between 1 and {app.config['MAX_BATCH_COUNT']}"}), 400
+    if not uploaded_file_path or not os.path.exists(uploaded_file_path):
+        return jsonify({'error': 'Uploaded file not found'}), 400
 
-        with open(uploaded_file_path, 'r', encoding='utf-8') as f:
-            code = f.read()
+    try:
+        digest = resolve_digest(uploaded_file_path)
+    except Exception as e:
+        print(e)
+        return jsonify({'error': str(e)}), 500
 
-        with NamedTemporaryFile(mode='w', suffix='.py', encoding='utf-8', delete=False) as temp_f:
-            temp_f.write(code)
-            temp_file_path = temp_f.name
+    def generate_item():
+        return produce(digest, uploaded_file_path, question_type, question_level, fragments=fragments)
 
-        try:
-            spec = importlib.util.spec_from_file_location("question_module", temp_file_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-
-            if hasattr(module, 'generate_question'):
-                result = module.generate_question(question_type, question_level)
-                # print(result)
-                parsed = json.loads(result)
-                # print('parsed',parsed)
-                print(jsonify({
-                    'output': {
-                        'question': parsed['question'],
-                        'options': parsed['options'],
-                        'correctAnswer': parsed['correctAnswer']
-                    }
-                }).data)
-                return jsonify({
-                    'output': {
-                        'question': parsed['question'],
-                        'options': parsed['options'],
-                        'correctAnswer': parsed['correctAnswer']
-                    }
-                })
-            else:
-                return jsonify({'error': 'generate_question() not found'}), 400
-        finally:
-            os.unlink(temp_file_path)
+    def output_line(index, result):
+        if '\n' in result:
+            # Pretty-printed generator output would break the one-line-per-item framing
+            result = json.dumps(json.loads(result), ensure_ascii=False)
+        return '{"index": %d, "output": %s}\n' % (index, result)
+
+    def error_line(index, error):
+        return json.dumps({'index': index, 'error': str(error)}, ensure_ascii=False) + '\n'
+
+    # Run the first item eagerly so a missing entry point is still a plain 400
+    try:
+        first = output_line(0, generate_item())
+    except GeneratorNotFound as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        first = error_line(0, e)
+
+    def generate():
+        yield first
+        for index in range(1, count):
+            # A failing item is reported on its own line and the stream carries on
+            try:
+                yield output_line(index, generate_item())
+            except Exception as e:
+                yield error_line(index, e)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def matrix_axis(values, full_range):
+    """Parse one axis of a matrix request; omitted or 'all' selects the full range."""
+    if values is None or values == 'all':
+        return list(full_range)
+    return [int(value) for value in values]
 
+@app.route('/preview-matrix', methods=['POST'])
+def preview_matrix():
+    """Run the generator over every (question_type, question_level) cell in parallel."""
+    try:
+        data = request.get_json()
+        uploaded_file_path = data.get('path')
+        question_types = matrix_axis(data.get('question_types'), QUESTION_TYPES)
+        question_levels = matrix_axis(data.get('question_levels'), QUESTION_LEVELS)
+        seed = data.get('seed')
+        seed = int(seed) if seed is not None else None
     except Exception as e:
-        print(e)    
+        return jsonify({'error': str(e)}), 400
+
+    cells = [(t, level) for t in question_types for level in question_levels]
+    if not 1 <= len(cells) <= app.config['MAX_MATRIX_CELLS']:
+        return jsonify({'error': f"matrix must have between 1 and {app.config['MAX_MATRIX_CELLS']} cells"}), 400
+    if not uploaded_file_path or not os.path.exists(uploaded_file_path):
+        return jsonify({'error': 'Uploaded file not found'}), 400
+
+    try:
+        digest = resolve_digest(uploaded_file_path)
+    except Exception as e:
+        print(e)
         return jsonify({'error': str(e)}), 500
 
+    def run_cell(cell):
+        question_type, question_level = cell
+        start = time.perf_counter()
+        try:
+            result = produce(digest, uploaded_file_path, question_type, question_level, seed)
+            error = None
+        except Exception as e:
+            result, error = None, str(e)
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+        head = json.dumps({
+            'question_type': question_type,
+            'question_level': question_level,
+            'elapsed_ms': elapsed_ms,
+        })
+        # Splice the generator's JSON in unchanged rather than re-encoding it
+        if error is None:
+            return elapsed_ms, head[:-1] + ', "output": ' + result + '}'
+        return elapsed_ms, head[:-1] + ', "error": ' + json.dumps(error, ensure_ascii=False) + '}'
+
+    start = time.perf_counter()
+    results = list(matrix_threads.map(run_cell, cells))
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+    slowest_ms = max(cell_ms for cell_ms, _ in results)
+    body = ('{"cells": [' + ', '.join(cell for _, cell in results) + '], '
+            f'"elapsed_ms": {elapsed_ms}, "slowest_cell_ms": {slowest_ms}}}')
+    return Response(body, mimetype='application/json')
+
+@app.route('/reservoirs')
+def reservoir_stats():
+    if reservoirs is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(reservoirs.stats(), enabled=True))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     app.run(debug=True,use_reloader=False)
@@ -0,0 +1,269 @@
+import random
+import re
+import sys
+import timeit
+from typing import List, Tuple
+
+from Sum_Product_Question_Gen_zI02OUj import (
+    TermLeaf, assemble_term_tree, compile_expression, draw_question, evaluate_term,
+    expansion_index_space, format_decimal, question_operators, term_leaves, term_tree_to_text,
+)
+
+# Numbers, commands, names, runs of characters the emitter copies as they are, or one
+# other character; each alternative is unambiguous, so the scan never backtracks
+_KATEX_TOKEN = re.compile(r'\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\\[A-Za-z]+|[A-Za-z_]\w*|[^\w.\\/^*×(){}-]+|.', re.S)
+_KATEX_BRACKETS = {'(': ')', '{': '}'}
+_KATEX_REWRITTEN = re.compile(r'[./^*×]|--')  # text without these converts to itself
+
+def tokenize_katex(text: str) -> List[str]:
+    """Split an expansion into tokens in one linear scan"""
+    return _KATEX_TOKEN.findall(text)
+
+def _starts_operand(tokens: List[str], position: int) -> bool:
+    """Whether a number, name or opening bracket starts at position"""
+    if position >= len(tokens):
+        return False
+    token = tokens[position]
+    return token[0].isalnum() or token[0] == '_' or token in _KATEX_BRACKETS
+
+def emit_katex(tokens: List[str]) -> str:
+    """Emit KaTeX from tokenize_katex() tokens in one left-to-right pass.
+
+    Decimals are rounded with format_decimal(), a/b becomes \\frac{a}{b},
+    exponents are braced, * and × become \\cdot and -- becomes +. The operands
+    of / and ^ are the atoms next to them (a number, a name with its call
+    arguments, or a bracketed group, optionally negated); open brackets are
+    kept on a stack, so every token is handled once.
+    """
+    pieces = []  # output of the innermost open bracket
+    stack = []  # (pieces, opener, call name, pending, atom) of every enclosing level
+    atom = None  # (text, bare) when pieces ends with a complete atom; bare drops outer brackets
+    pending = None  # (operator, left atom, negated) waiting for its right operand
+    position, count = 0, len(tokens)
+    
+    while position < count or stack:
+        if position < count:
+            token = tokens[position]
+            position += 1
+        else:
+            # An unclosed bracket closes at the end, without its closing symbol
+            token = None
+        
+        if token and (token[0].isalnum() or token[0] == '_'):
+            if token[0].isdigit():
+                value = format_decimal(token) if '.' in token else token
+            elif position < count and tokens[position] == '(':
+                stack.append((pieces, '(', token, pending, atom))
+                pieces, pending, atom = [], None, None
+                position += 1
+                continue
+            else:
+                value = token
+            operand = (value, value)
+        elif token in _KATEX_BRACKETS:
+            stack.append((pieces, token, None, pending, atom))
+            pieces, pending, atom = [], None, None
+            continue
+        elif stack and (token is None or token == _KATEX_BRACKETS[stack[-1][1]]):
+            inner = ''.join(pieces)
+            pieces, opener, name, pending, atom = stack.pop()
+            closer = _KATEX_BRACKETS[opener] if token else ''
+            if name:
+                value = f"{name}({inner}{closer}"
+                operand = (value, value)
+            else:
+                operand = (f"{opener}{inner}{closer}", inner)
+        else:
+            if (token == '/' or token == '^') and atom:
+                negated = position < count and tokens[position] == '-'
+                if _starts_operand(tokens, position + negated):
+                    pieces.pop()
+                    pending = (token, atom, negated)
+                    atom = None
+                    position += negated
+                    continue
+            if token == '-' and position < count and tokens[position] == '-':
+                position += 1
+                token = '+'
+            elif token == '*' or token == '×':
+                following = tokens[position][0] if position < count else ''
+                token = '\\cdot ' if following.isalpha() or following == '_' else '\\cdot'
+            pieces.append(token)
+            atom = None
+            continue
+        
+        # A complete operand: finish a pending / or ^ with it, then keep it as the last atom
+        if pending:
+            operator, left, negated = pending
+            pending = None
+            right = f"-{operand[0]}" if negated else operand[1]
+            if operator == '/':
+                value = f"\\frac{{{left[1]}}}{{{right}}}"
+            else:
+                value = f"{left[0]}^{{{right}}}"
+            operand = (value, value)
+        pieces.append(operand[0])
+        atom = operand
+    return ''.join(pieces)
+
+def convert_to_katex(expansion: str) -> str:
+    """Convert expansion to proper KaTeX notation with decimal formatting.
+
+    The generator renders KaTeX straight from term trees with
+    term_tree_to_katex(); this string converter is kept here as the emitter
+    the regex cascade is measured against. Only the left side of an equation
+    is converted, in one tokenize_katex() scan and one emit_katex() pass.
+    """
+    if '=' in expansion:
+        expansion = expansion.split('=')[0].strip()
+    if not _KATEX_REWRITTEN.search(expansion):
+        return expansion
+    return emit_katex(tokenize_katex(expansion))
+
+def convert_to_katex_regex(expansion: str) -> str:
+    """The regex-cascade conversion convert_to_katex() replaced, kept as its baseline"""
+    if not expansion or '=' not in expansion:
+        # Format decimal numbers in the expansion
+        terms = expansion.split(' ')
+        formatted_terms = []
+        for term in terms:
+            if '\\cdot' in term or '+' in term or term.strip() in ['\\cdot', '+']:
+                formatted_terms.append(term)
+            else:
+                formatted_terms.append(format_decimal(term))
+        expansion = ' '.join(formatted_terms)
+        
+        # Format power expressions in the expansion
+        if '^' in expansion:
+            # Handle expressions with parentheses first
+            expansion = re.sub(r'\((.*?)\)\^(-?\d+)(?!})', r'(\1)^{\2}', expansion)
+            # Handle simple expressions without parentheses
+            expansion = re.sub(r'([^\^]*?)\^(-?\d+)(?!})', r'\1^{\2}', expansion)
+        return expansion.replace('*', '\\cdot')
+
+    # Split the expression and result
+    parts = expansion.split('=')
+    expression = parts[0].strip()
+    
+    # Replace all multiplication symbols with \cdot
+    expression = expression.replace('×', '\\cdot').replace('*', '\\cdot')
+    
+    # Convert division expressions to fractions
+    def convert_division(match):
+        numerator, denominator = match.group(1), match.group(2)
+        # Handle arithmetic in numerator and denominator
+        if '--' in numerator:
+            numerator = numerator.replace('--', '+')
+        if '--' in denominator:
+            denominator = denominator.replace('--', '+')
+        # Remove any stray parentheses around single numbers in denominator
+        if denominator.startswith('(') and denominator.endswith(')'):
+            denominator = denominator.strip('()')  # Simply strip parentheses
+            try:
+                # Check if it's a number and not zero
+                if float(denominator) == 0:
+                    denominator = '0'
+                else:
+                    denominator = str(float(denominator))
+            except ValueError:
+                # If not a simple number, put parentheses back
+                denominator = f"({denominator})"
+        return f"\\frac{{{numerator}}}{{{denominator.strip('()')}}}"
+    
+    # Handle division with parentheses first
+    expression = re.sub(r'\(([^/]+)\)/\(([^)]+)\)', convert_division, expression)
+    # Handle simple divisions
+    expression = re.sub(r'([^/]+)/([^+\s\\\cdot]+)', convert_division, expression)
+    
+    # Pre-process power expressions with arithmetic
+    def process_power_expr(match):
+        expr = match.group(1)
+        power = match.group(2)
+        # Handle arithmetic in the base
+        if '--' in expr:
+            expr = expr.replace('--', '+')
+        # Format the power - always wrap in curly braces for consistency
+        power = '{' + power + '}'
+        return f"({expr})^{power}"
+    
+    # Handle power expressions with arithmetic in base
+    expression = re.sub(r'\(([-\d]+--[-\d]+)\)\^(-?\d+)', process_power_expr, expression)
+    
+    # Format the expression
+    terms = expression.split('\\cdot')
+    formatted_terms = []
+    for term in terms:
+        term = term.strip()
+        
+        # Handle expressions with powers
+        if '^' in term:
+            if term.startswith('(') and term.endswith(')') and '^{' in term:
+                # Already properly formatted with curly braces
+                formatted_terms.append(term)
+                continue
+                
+            base, exponent = term.split('^', 1)
+            # Clean up the base
+            base = base.strip()
+            if '(' in base or '+' in base or '-' in base:
+                base = f"({base})"
+            
+            # Clean up the exponent and ensure it's wrapped in curly braces
+            exponent = exponent.strip()
+            if not (exponent.startswith('{') and exponent.endswith('}')):
+                exponent = '{' + exponent + '}'
+            
+            formatted_term = f"{base}^{exponent}"
+        else:
+            formatted_term = term
+            
+        formatted_terms.append(formatted_term)
+    
+    # Join terms with proper multiplication symbol
+    expression = ' \\cdot '.join(formatted_terms)
+    
+    # Final cleanup for any remaining arithmetic in powers
+    expression = re.sub(r'\((\d+)--(\d+)\)', r'(\1+\2)', expression)
+    
+    # Ensure all remaining exponents are wrapped in curly braces
+    expression = re.sub(r'\^(-?\d+)(?!})', r'^{\1}', expression)
+    # Handle any remaining power expressions with parentheses
+    expression = re.sub(r'\((.*?)\)\^(-?\d+)(?!})', r'(\1)^{\2}', expression)
+    
+    return expression
+
+def benchmark_katex_conversion(sizes: Tuple[int, ...] = (1, 4, 16, 64), repeats: int = 5,
+                               seed: int = 0) -> List[dict]:
+    """Time convert_to_katex() against convert_to_katex_regex() on triple expansions.
+
+    A seeded level-3 triple question is expanded two ways: 'powers' writes
+    the index values into every (i-j)^k term, 'mixed' evaluates every term
+    but the first. Each is repeated size times; a row holds the text length
+    and the best of repeats timings, in seconds, of both converters.
+    """
+    question = draw_question("SSS", 3, rng=random.Random(seed))
+    compiled = compile_expression(question['expression'])
+    indices, row_pointers = expansion_index_space(question)
+    cells = list(zip(*(column.tolist() for column in indices)))
+    ops = question_operators(question)
+    powers = [TermLeaf(compiled.substitute(*cell)) for cell in cells]
+    mixed = powers[:1] + term_leaves([evaluate_term(compiled.source, *cell) for cell in cells[1:]])
+    expansions = {
+        'powers': term_tree_to_text(assemble_term_tree(ops, powers, row_pointers)),
+        'mixed': term_tree_to_text(assemble_term_tree(ops, mixed, row_pointers)),
+    }
+    
+    rows = []
+    for shape, expansion in expansions.items():
+        for size in sizes:
+            text = ' + '.join([expansion] * size)
+            row = {'shape': shape, 'size': size, 'length': len(text)}
+            for name, convert in (('regex', convert_to_katex_regex), ('emitter', convert_to_katex)):
+                row[name] = min(timeit.repeat(lambda: convert(text), number=1, repeat=repeats))
+            rows.append(row)
+    return rows
+
+if __name__ == "__main__":
+    for row in benchmark_katex_conversion():
+        print(f"{row['shape']:>6} {row['length']:>8} chars  regex {row['regex'] * 1e3:9.3f} ms  "
+              f"emitter {row['emitter'] * 1e3:9.3f} ms")
@@ -0,0 +1,87 @@
+import json
+import re
+import subprocess
+import sys
+
+# Packages worth calling out when an upload pulls them in at import time
+HEAVY_MODULES = {'numpy', 'pandas', 'scipy', 'sklearn', 'matplotlib', 'torch', 'tensorflow'}
+
+_MARKER = '@@aq-import-start'
+# -X importtime indents nested imports; top-level ones have a single space after the bar
+_TOP_LEVEL_IMPORT = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| (\S+)$')
+
+_PROFILE_SCRIPT = '''
+import importlib.util, json, marshal, resource, sys, time, types
+def peak_rss_kb():
+    # VmHWM starts afresh at exec, unlike ru_maxrss which inherits the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+path = sys.argv[1]
+baseline_kb = peak_rss_kb()
+sys.stderr.write(%r + "\\n")
+sys.stderr.flush()
+start = time.perf_counter()
+if path.endswith(".pyc"):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != importlib.util.MAGIC_NUMBER:
+        raise ImportError("bytecode was compiled by a different Python version")
+    code = marshal.loads(data[16:])
+else:
+    with open(path, "rb") as f:
+        code = compile(f.read(), path, "exec")
+module = types.ModuleType("question_module")
+module.__file__ = path
+exec(code, module.__dict__)
+wall = time.perf_counter() - start
+sys.stderr.flush()
+print(json.dumps({
+    "wall_ms": round(wall * 1000, 2),
+    "peak_rss_kb": peak_rss_kb(),
+    "baseline_rss_kb": baseline_kb,
+}))
+''' % _MARKER
+
+
+def profile_import(path: str, timeout: float = 60, top: int = 10) -> dict:
+    """Import the generator at ``path`` in a fresh interpreter and report what it costs.
+
+    Returns the wall time of executing the module, its peak RSS and the growth
+    over a bare interpreter, and the slowest top-level imports it triggered.
+    """
+    try:
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', _PROFILE_SCRIPT, path],
+            capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return {'error': f'import did not finish within {timeout}s'}
+
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        return {'error': lines[-1] if lines else f'import exited with status {completed.returncode}'}
+
+    profile = json.loads(completed.stdout.strip().splitlines()[-1])
+    profile['rss_growth_kb'] = profile['peak_rss_kb'] - profile.pop('baseline_rss_kb')
+
+    imports = []
+    _, _, module_imports = completed.stderr.partition(_MARKER)
+    for line in module_imports.splitlines():
+        match = _TOP_LEVEL_IMPORT.match(line)
+        if match:
+            name = match.group(2)
+            imports.append({
+                'module': name,
+                'cumulative_ms': round(int(match.group(1)) / 1000, 2),
+                'heavy': name.split('.')[0] in HEAVY_MODULES,
+            })
+    imports.sort(key=lambda item: item['cumulative_ms'], reverse=True)
+    profile['top_imports'] = imports[:top]
+    profile['heavy_imports'] = sorted({item['module'].split('.')[0] for item in imports if item['heavy']})
+    return profile
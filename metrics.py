@@ -0,0 +1,115 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds; the implicit +Inf bucket catches the rest
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def bounded_label(value, known, other: str = 'other') -> str:
+    """``str(value)`` when it is one of ``known``, else ``other``.
+
+    Label values taken from requests go through this so arbitrary input
+    cannot create an unbounded number of series.
+    """
+    value = str(value)
+    return value if value in known else other
+
+
+class Histogram:
+    """A labelled latency histogram; one bucket array per distinct label tuple."""
+
+    def __init__(self, name: str, help: str, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, seconds: float) -> None:
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _format_labels(self.label_names, labels, f'le="{bound}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            cumulative += series[len(self.buckets)]
+            inf = _format_labels(self.label_names, labels, 'le="+Inf"')
+            yield f'{self.name}_bucket{inf} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}'
+            yield f'{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}'
+
+
+class PhaseTimer:
+    """Collects consecutive phase durations for one request.
+
+    Each ``mark(phase)`` records the time since the previous mark; ``finish``
+    writes them all to a histogram once the request's labels are known.
+    """
+
+    __slots__ = ('_last', '_phases')
+
+    def __init__(self):
+        self._last = time.perf_counter()
+        self._phases = []
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self._phases.append((phase, now - self._last))
+        self._last = now
+
+    def finish(self, histogram: Histogram, *labels) -> None:
+        for phase, seconds in self._phases:
+            histogram.observe(labels + (phase,), seconds)
+
+
+class MetricsRegistry:
+    """Holds histograms and callback gauges and renders Prometheus text format."""
+
+    def __init__(self):
+        self._histograms = []
+        self._gauges = []
+
+    def histogram(self, name: str, help: str, label_names, buckets=DEFAULT_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, label_names, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, help: str, callback) -> None:
+        """Register a gauge whose value is read from ``callback()`` at scrape time."""
+        self._gauges.append((name, help, callback))
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for name, help, callback in self._gauges:
+            try:
+                value = callback()
+            except Exception:
+                continue
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
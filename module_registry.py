@@ -0,0 +1,157 @@
+import hashlib
+import importlib.util
+import marshal
+import os
+import threading
+import time
+import types
+from collections import OrderedDict
+
+
+def source_digest(source: bytes) -> str:
+    """Return the SHA-256 hex digest used to key uploaded generator sources."""
+    return hashlib.sha256(source).hexdigest()
+
+
+def bytecode_path(path: str) -> str:
+    """Where the compiled bytecode for the generator source at ``path`` is kept."""
+    return os.path.splitext(path)[0] + '.pyc'
+
+
+def load_bytecode(path: str):
+    """Return the code object stored in the .pyc at ``path``, or None if absent,
+    corrupt or written by another Python version.
+
+    The source hash in the header is not checked, so the caller must know the
+    .pyc belongs to the source it expects.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # 16-byte header: magic number, flags and the 8-byte source hash
+    if data[:4] != importlib.util.MAGIC_NUMBER:
+        return None
+    try:
+        return marshal.loads(data[16:])
+    except (ValueError, EOFError, ImportError):
+        # Truncated or corrupt bytecode; the caller compiles the source instead
+        return None
+
+
+class ModuleRegistry:
+    """Process-wide cache of executed generator modules keyed by source SHA-256.
+
+    Entries are evicted least-recently-used once ``max_entries`` is exceeded and
+    dropped once they have been idle for longer than ``ttl`` seconds.
+    """
+
+    def __init__(self, max_entries: int = 32, ttl: float = 600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # digest -> [module, last_used]
+        self._lock = threading.Lock()
+        self._loading = {}  # digest -> Lock held while the module executes
+
+    def load(self, path: str, digest: str = None):
+        """Return ``(digest, module)`` for ``path``, executing it only on a miss.
+
+        When the caller already knows the digest, the file is only read on a miss.
+        Content-addressed paths (named ``<digest>.py``, as in the upload store) run
+        the bytecode compiled at upload time without parsing the source; any other
+        path's .pyc may belong to different source, so it is never used.
+        """
+        if digest is not None:
+            module = self.get(digest)
+            if module is not None:
+                return digest, module
+            if os.path.basename(path) == f'{digest}.py':
+                code = load_bytecode(bytecode_path(path))
+                if code is not None:
+                    return digest, self.get_or_load(digest, code, path)
+        with open(path, 'rb') as f:
+            source = f.read()
+        digest = source_digest(source)
+        return digest, self.get_or_load(digest, source, path)
+
+    def get(self, digest: str):
+        """Return the cached module for ``digest`` or None, counting a hit when found."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            self.hits += 1
+            entry[1] = now
+            self._entries.move_to_end(digest)
+            return entry[0]
+
+    def get_or_load(self, digest: str, source, path: str = '<upload>'):
+        """Return the module for ``digest``, executing ``source`` if it is not cached.
+
+        ``source`` may be the raw bytes or an already compiled code object.
+        """
+        module = self.get(digest)
+        if module is not None:
+            return module
+
+        with self._lock:
+            loading = self._loading.setdefault(digest, threading.Lock())
+
+        # Serialise concurrent misses for the same source so it executes once
+        with loading:
+            module = self.get(digest)
+            if module is not None:
+                return module
+            with self._lock:
+                self.misses += 1
+            try:
+                module = self._execute(digest, source, path)
+                # Publish before dropping the loading lock so late arrivals find the module
+                self._store(digest, module)
+            finally:
+                with self._lock:
+                    self._loading.pop(digest, None)
+            return module
+
+    def evict(self, digest: str) -> None:
+        with self._lock:
+            self._entries.pop(digest, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'entries': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+        }
+
+    def _execute(self, digest: str, source, path: str):
+        module = types.ModuleType(f"question_module_{digest[:12]}")
+        module.__file__ = path
+        code = source if isinstance(source, types.CodeType) else compile(source, path, 'exec')
+        exec(code, module.__dict__)
+        return module
+
+    def _store(self, digest: str, module) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._entries[digest] = [module, now]
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _expire(self, now: float) -> None:
+        # Entries are kept in last-used order, so stop at the first fresh one
+        while self._entries:
+            _, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used <= self.ttl:
+                break
+            self._entries.popitem(last=False)
@@ -0,0 +1,125 @@
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Reservoir:
+    __slots__ = ('path', 'items', 'hits', 'misses', 'produced', 'refilling', 'last_error')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.items = deque()
+        self.hits = 0
+        self.misses = 0
+        self.produced = 0
+        self.refilling = False
+        self.last_error = None
+
+
+class ReservoirManager:
+    """Bounded pools of ready questions per (module digest, question_type, question_level).
+
+    ``produce(digest, path, question_type, question_level)`` generates one question.
+    A request pops a ready question in O(1); whenever a reservoir drops below
+    ``low_water`` a background refill tops it back up to ``size``. At most
+    ``refill_workers`` refills run at once and only the ``max_keys`` most recently
+    used reservoirs are kept.
+    """
+
+    def __init__(self, produce, size: int = 16, low_water: int = 4,
+                 refill_workers: int = 2, max_keys: int = 64):
+        self.produce = produce
+        self.size = size
+        self.low_water = low_water
+        self.max_keys = max_keys
+        self._reservoirs = OrderedDict()
+        self._lock = threading.Lock()
+        self._refills = ThreadPoolExecutor(max_workers=refill_workers,
+                                           thread_name_prefix='reservoir-refill')
+
+    def get(self, digest: str, path: str, question_type: int, question_level: int) -> str:
+        """Return a ready question, generating one inline if the reservoir is empty."""
+        key = (digest, question_type, question_level)
+        with self._lock:
+            reservoir = self._reservoirs.get(key)
+            if reservoir is None:
+                reservoir = self._reservoirs[key] = _Reservoir(path)
+                while len(self._reservoirs) > self.max_keys:
+                    self._reservoirs.popitem(last=False)
+            else:
+                self._reservoirs.move_to_end(key)
+                reservoir.path = path
+            item = reservoir.items.popleft() if reservoir.items else None
+            if item is None:
+                reservoir.misses += 1
+            else:
+                reservoir.hits += 1
+            self._schedule_refill(key, reservoir)
+
+        if item is None:
+            item = self.produce(digest, path, question_type, question_level)
+        return item
+
+    def stats(self) -> dict:
+        with self._lock:
+            reservoirs = [
+                {
+                    'digest': digest,
+                    'question_type': question_type,
+                    'question_level': question_level,
+                    'ready': len(reservoir.items),
+                    'hits': reservoir.hits,
+                    'misses': reservoir.misses,
+                    'produced': reservoir.produced,
+                    'refilling': reservoir.refilling,
+                    'last_error': reservoir.last_error,
+                }
+                for (digest, question_type, question_level), reservoir in self._reservoirs.items()
+            ]
+        hits = sum(r['hits'] for r in reservoirs)
+        misses = sum(r['misses'] for r in reservoirs)
+        return {
+            'size': self.size,
+            'low_water': self.low_water,
+            'max_keys': self.max_keys,
+            'hits': hits,
+            'misses': misses,
+            'reservoirs': reservoirs,
+        }
+
+    def shutdown(self) -> None:
+        self._refills.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule_refill(self, key, reservoir: _Reservoir) -> None:
+        # Called with self._lock held
+        if reservoir.refilling or len(reservoir.items) >= self.low_water:
+            return
+        reservoir.refilling = True
+        try:
+            self._refills.submit(self._refill, key, reservoir)
+        except RuntimeError:
+            # Executor already shut down
+            reservoir.refilling = False
+
+    def _refill(self, key, reservoir: _Reservoir) -> None:
+        digest, question_type, question_level = key
+        try:
+            while len(reservoir.items) < self.size:
+                with self._lock:
+                    # Stop feeding reservoirs that have been evicted
+                    if self._reservoirs.get(key) is not reservoir:
+                        return
+                    path = reservoir.path
+                try:
+                    item = self.produce(digest, path, question_type, question_level)
+                except Exception as e:
+                    # Leave it to the next request to retry rather than spinning here
+                    reservoir.last_error = str(e)
+                    return
+                with self._lock:
+                    reservoir.items.append(item)
+                    reservoir.produced += 1
+                    reservoir.last_error = None
+        finally:
+            with self._lock:
+                reservoir.refilling = False
@@ -0,0 +1,166 @@
+import hashlib
+import io
+import json
+import os
+import py_compile
+import re
+import tempfile
+import threading
+
+from module_registry import bytecode_path
+
+CHUNK_SIZE = 64 * 1024
+_DIGEST_NAME = re.compile(r'^([0-9a-f]{64})\.py$')
+
+
+class UploadStore:
+    """Content-addressed storage for uploaded generator sources.
+
+    Each distinct source is stored once as ``<folder>/objects/<sha256>.py``,
+    alongside its compiled ``.pyc`` and import profile, and
+    ``<folder>/aliases.json`` maps every uploaded filename to the digest of its
+    latest upload. The digest is computed while the request body is read, and an
+    upload whose content is already stored is not written to disk again.
+    """
+
+    def __init__(self, folder: str, spool_limit: int = 1024 * 1024):
+        self.folder = folder
+        self.objects = os.path.join(folder, 'objects')
+        self.alias_file = os.path.join(folder, 'aliases.json')
+        self.spool_limit = spool_limit
+        self._lock = threading.Lock()
+        os.makedirs(self.objects, exist_ok=True)
+        self._aliases = self._read_aliases()
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.objects, f'{digest}.py')
+
+    def bytecode_path(self, digest: str) -> str:
+        return bytecode_path(self.path_for(digest))
+
+    def compile(self, digest: str) -> str:
+        """Compile the stored source to a .pyc next to it and return the .pyc path.
+
+        Raises py_compile.PyCompileError if the source does not compile.
+        """
+        cfile = self.bytecode_path(digest)
+        if not os.path.exists(cfile):
+            # The file name already pins the content, so the hash need not be re-checked
+            py_compile.compile(self.path_for(digest), cfile=cfile, doraise=True,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        return cfile
+
+    def has(self, digest: str) -> bool:
+        """Whether ``digest`` names a stored source."""
+        return _DIGEST_NAME.match(f'{digest}.py') is not None and os.path.exists(self.path_for(digest))
+
+    def discard(self, digest: str, filename: str) -> None:
+        """Remove a stored source with its bytecode and profile, and ``filename``'s alias to it.
+
+        Used when an upload turns out not to be a usable generator.
+        """
+        for path in (self.path_for(digest), self.bytecode_path(digest), self._profile_path(digest)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            if self._aliases.get(filename) != digest:
+                return
+            del self._aliases[filename]
+            self._write_aliases()
+
+    def load_profile(self, digest: str):
+        try:
+            with open(self._profile_path(digest), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_profile(self, digest: str, profile: dict) -> None:
+        fd, temp_path = tempfile.mkstemp(dir=self.objects, suffix='.part')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(profile, f)
+        os.replace(temp_path, self._profile_path(digest))
+
+    def resolve(self, path: str):
+        """Return the digest for a path inside the object store, or None for any other path."""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.objects):
+            return None
+        match = _DIGEST_NAME.match(os.path.basename(path))
+        return match.group(1) if match else None
+
+    def alias(self, filename: str):
+        with self._lock:
+            return self._aliases.get(filename)
+
+    def save(self, stream, filename: str):
+        """Store the upload read from ``stream`` under its content hash.
+
+        Returns ``(digest, path, created)`` where ``created`` is False when the
+        same content was already stored.
+        """
+        sha256 = hashlib.sha256()
+        buffer = io.BytesIO()
+        spill = None  # (fd, temp path) once the upload outgrows the in-memory buffer
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                if spill is None:
+                    buffer.write(chunk)
+                    if buffer.tell() > self.spool_limit:
+                        spill = tempfile.mkstemp(dir=self.objects, suffix='.part')
+                        os.write(spill[0], buffer.getvalue())
+                        buffer = None
+                else:
+                    os.write(spill[0], chunk)
+
+            digest = sha256.hexdigest()
+            path = self.path_for(digest)
+            created = not os.path.exists(path)
+            if created:
+                if spill is None:
+                    spill = tempfile.mkstemp(dir=self.objects, suffix='.part')
+                    os.write(spill[0], buffer.getvalue())
+                fd, temp_path = spill
+                spill = None
+                os.close(fd)
+                try:
+                    os.replace(temp_path, path)
+                except OSError:
+                    os.unlink(temp_path)
+                    raise
+        finally:
+            if spill is not None:
+                os.close(spill[0])
+                os.unlink(spill[1])
+
+        self._set_alias(filename, digest)
+        return digest, path, created
+
+    def _profile_path(self, digest: str) -> str:
+        return os.path.join(self.objects, f'{digest}.profile.json')
+
+    def _set_alias(self, filename: str, digest: str) -> None:
+        with self._lock:
+            if self._aliases.get(filename) == digest:
+                return
+            self._aliases[filename] = digest
+            self._write_aliases()
+
+    def _write_aliases(self) -> None:
+        # Called with self._lock held
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.part')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self._aliases, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.alias_file)
+
+    def _read_aliases(self) -> dict:
+        try:
+            with open(self.alias_file, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,348 @@
+import importlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from module_registry import ModuleRegistry, source_digest
+
+PRELOAD_MODULES = ('numpy', 'pandas', 'sklearn')
+REQUIRED_OUTPUT_KEYS = ('question', 'options', 'correctAnswer')
+
+
+class GeneratorError(Exception):
+    """Raised when an uploaded generator fails to load or run."""
+
+
+class GeneratorNotFound(GeneratorError):
+    """Raised when an uploaded module does not define generate_question()."""
+
+
+class GeneratorTimeout(GeneratorError):
+    """Raised when a generator call exceeds its time limit."""
+
+
+def read_source(path: str):
+    """Return ``(digest, source)`` for the generator at ``path``."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    return source_digest(source), source
+
+
+def validate_output(result: str) -> str:
+    """Check a generate_question() JSON string with a single parse and return it unchanged.
+
+    The string is passed through to clients as-is, so it is never re-encoded.
+    """
+    parsed = json.loads(result)
+    if not isinstance(parsed, dict):
+        raise GeneratorError('generate_question() must return a JSON object')
+    missing = [key for key in REQUIRED_OUTPUT_KEYS if key not in parsed]
+    if missing:
+        if 'error' in parsed:
+            raise GeneratorError(str(parsed['error']))
+        raise GeneratorError(f"generate_question() output is missing {', '.join(missing)}")
+    return result
+
+
+_rng_lock = threading.Lock()
+
+
+@contextmanager
+def seeded_rngs(seed):
+    """Seed ``random`` and ``numpy.random`` for one call and restore their state afterwards.
+
+    With ``seed=None`` the global generators are left alone and nothing is locked.
+    Seeded calls are serialised so concurrent threads in this process cannot
+    interleave draws.
+    """
+    if seed is None:
+        yield
+        return
+    with _rng_lock:
+        np = sys.modules.get('numpy')
+        state = random.getstate()
+        np_state = np.random.get_state() if np is not None else None
+        random.seed(seed)
+        if np is not None:
+            np.random.seed(seed % 2 ** 32)
+        try:
+            yield
+        finally:
+            random.setstate(state)
+            if np_state is not None:
+                np.random.set_state(np_state)
+
+
+def call_generator(registry: ModuleRegistry, task: dict, timings: dict = None) -> str:
+    """Load the task's module through ``registry`` and run generate_question().
+
+    When ``timings`` is given it is filled with the import, generate and validate
+    phase durations in seconds and whether the module came from the cache.
+    A ``seed`` in the task makes the call reproducible; see seeded_rngs(). A true
+    ``fragments`` asks the generator for its fragment output mode; it is only
+    passed when set, so generators without that keyword keep working.
+    """
+    start = time.perf_counter()
+    module = registry.get(task['digest'])
+    cache_hit = module is not None
+    if module is None:
+        _, module = registry.load(task['path'], task['digest'])
+    loaded = time.perf_counter()
+    if timings is not None:
+        timings['cache_hit'] = cache_hit
+        timings['import'] = loaded - start
+    if not hasattr(module, 'generate_question'):
+        raise GeneratorNotFound('generate_question() not found')
+    with seeded_rngs(task.get('seed')):
+        if task.get('fragments'):
+            result = module.generate_question(task['question_type'], task['question_level'], fragments=True)
+        else:
+            result = module.generate_question(task['question_type'], task['question_level'])
+    generated = time.perf_counter()
+    validate_output(result)
+    if timings is not None:
+        timings['generate'] = generated - loaded
+        timings['validate'] = time.perf_counter() - generated
+    return result
+
+
+def _current_rss_kb() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _worker_main(conn, preload, cache_size, cache_ttl):
+    """Serve generate calls sent over ``conn`` until the pipe closes."""
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    registry = ModuleRegistry(cache_size, cache_ttl)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        timings = {}
+        try:
+            result = call_generator(registry, message, timings)
+            conn.send(('ok', result, _current_rss_kb(), timings))
+        except GeneratorNotFound as e:
+            conn.send(('missing', str(e), _current_rss_kb(), timings))
+        except Exception as e:
+            conn.send(('error', str(e), _current_rss_kb(), timings))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx, preload, cache_size, cache_ttl):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, preload, cache_size, cache_ttl),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.calls = 0
+        self.rss_kb = 0
+
+    def stop(self, graceful: bool = True) -> None:
+        if graceful and self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """Pre-started processes that execute uploaded generators off the request thread.
+
+    Each worker imports the heavy data libraries once at startup and keeps its own
+    ModuleRegistry. Workers are replaced when a call times out or crashes, and
+    recycled after ``max_calls`` calls or once their RSS exceeds ``max_rss_mb``.
+    """
+
+    def __init__(self, size: int = None, timeout: float = 10, max_calls: int = 500,
+                 max_rss_mb: int = 512, preload=PRELOAD_MODULES,
+                 cache_size: int = 32, cache_ttl: float = 600):
+        self.size = size or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_calls = max_calls
+        self.max_rss_kb = max_rss_mb * 1024
+        self._worker_args = (tuple(preload), cache_size, cache_ttl)
+        # Workers are also replaced at runtime, when the server already runs threads; a
+        # forked child could inherit a lock another thread holds, so start them from a
+        # single-threaded fork server (or a fresh interpreter) that has the preload imported
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self._ctx = multiprocessing.get_context('forkserver')
+            self._ctx.set_forkserver_preload(list(preload))
+        else:
+            self._ctx = multiprocessing.get_context('spawn')
+        # LIFO hands out the most recently used, and therefore warmest, worker
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._closed = False
+        self.recycled = 0
+        self.timeouts = 0
+        self.module_hits = 0
+        self.module_misses = 0
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+
+    def generate(self, digest: str, path: str, question_type: int, question_level: int,
+                 timeout: float = None, timings: dict = None, seed: int = None,
+                 fragments: bool = False) -> str:
+        """Run generate_question() in a worker and return its validated JSON string.
+
+        ``timings`` is filled as described in call_generator().
+        """
+        task = {
+            'digest': digest,
+            'path': path,
+            'question_type': question_type,
+            'question_level': question_level,
+            'seed': seed,
+            'fragments': fragments,
+        }
+        return self._call(task, self.timeout if timeout is None else timeout, timings)
+
+    def queue_depth(self) -> int:
+        """Number of requests currently waiting for a free worker."""
+        return self._waiting
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'idle': self._idle.qsize(),
+            'waiting': self._waiting,
+            'recycled': self.recycled,
+            'timeouts': self.timeouts,
+            'module_hits': self.module_hits,
+            'module_misses': self.module_misses,
+        }
+
+    def shutdown(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.stop()
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self._ctx, *self._worker_args)
+
+    def _acquire(self) -> _Worker:
+        with self._lock:
+            self._waiting += 1
+        try:
+            return self._idle.get()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def _release(self, worker: _Worker) -> None:
+        if self._closed:
+            worker.stop()
+        else:
+            self._idle.put(worker)
+
+    def _replace(self, worker: _Worker, graceful: bool) -> _Worker:
+        worker.stop(graceful)
+        self.recycled += 1
+        return self._spawn()
+
+    def _call(self, task: dict, timeout: float, timings: dict = None) -> str:
+        worker = self._acquire()
+        try:
+            try:
+                worker.conn.send(task)
+                if not worker.conn.poll(timeout):
+                    self.timeouts += 1
+                    worker = self._replace(worker, graceful=False)
+                    raise GeneratorTimeout(f'generate_question() timed out after {timeout}s')
+                status, payload, rss_kb, worker_timings = worker.conn.recv()
+            except (EOFError, BrokenPipeError, OSError):
+                worker = self._replace(worker, graceful=False)
+                raise GeneratorError('worker process exited unexpectedly')
+
+            worker.calls += 1
+            worker.rss_kb = rss_kb
+            if 'cache_hit' in worker_timings:
+                if worker_timings['cache_hit']:
+                    self.module_hits += 1
+                else:
+                    self.module_misses += 1
+            if timings is not None:
+                timings.update(worker_timings)
+            if worker.calls >= self.max_calls or rss_kb > self.max_rss_kb:
+                worker = self._replace(worker, graceful=True)
+
+            if status == 'missing':
+                raise GeneratorNotFound(payload)
+            if status == 'error':
+                raise GeneratorError(payload)
+            return payload
+        finally:
+            self._release(worker)
+
+
+class InlineExecutor:
+    """Runs generators on the calling thread; used when the worker pool is disabled."""
+
+    def __init__(self, registry: ModuleRegistry):
+        self.registry = registry
+
+    def generate(self, digest: str, path: str, question_type: int, question_level: int,
+                 timeout: float = None, timings: dict = None, seed: int = None,
+                 fragments: bool = False) -> str:
+        task = {
+            'digest': digest,
+            'path': path,
+            'question_type': question_type,
+            'question_level': question_level,
+            'seed': seed,
+            'fragments': fragments,
+        }
+        try:
+            return call_generator(self.registry, task, timings)
+        except GeneratorError:
+            raise
+        except Exception as e:
+            raise GeneratorError(str(e)) from e
+
+    def queue_depth(self) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        return {
+            'size': 0,
+            'module_hits': self.registry.hits,
+            'module_misses': self.registry.misses,
+        }
+
+    def shutdown(self) -> None:
+        pass